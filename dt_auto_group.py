@@ -1,4 +1,5 @@
 from pytable.models import Image, ImageFlags, FilmRoll
+from pytable.edit import UnitOfWork
 from datetime import datetime, timedelta
 import os
 
@@ -176,50 +177,51 @@ def main(date_from, force, dry_run):
         by_model[key].append(image)
 
     n = 0
-    for model, images in by_model.items():
-
-        images = images[:]
-        prefer_raw = True
-        while len(images) > 0:
-            if model[1].name == "DSC-RX100":
-                group, images = consume_group_exposure_bracketing(images)
-            elif model[1].name == "ZV-1" or model[1].name == "ILCE-6700":
-                original_images = images
-                group, images = consume_group_exposure_bracketing(original_images)
-                group_burst, images_burst = consume_group_burst(original_images)
-                if len(group_burst) > len(group):
-                    group, images = group_burst, images_burst
-            elif model[1].name == "Pixel 6":
-                group, images = consume_group_pixel_6(images)
-                prefer_raw = False
-
-            elif (
-                model[1].name == "HERO9 Black" or
-                model[1].name == "HERO11 Black"
-            ):
-                group, images = consume_group_burst(images, timedelta(seconds=3))
-                prefer_raw = False
-            elif (
-                model[1].name == "HERO3+ Black Edition" or
-                model[1].name == "iPhone 12 mini" or
-                model[1].name == "iPhone 15 Pro Max"
-            ):
-                group, images = images[:1], images[1:]
-            else:
-                if model[1].name != '':
-                    for image in images:
-                        print(image)
-                    print("Unkown model {} - {}".format(*model))
-                break
-
-            has_changes, will_degrade = validate_group(group, prefer_raw)
-            if has_changes:
-                n += 1
-
-                if not dry_run and (not will_degrade or force):
-                    for image in group:
-                        print("Saving {}".format(image))
-                        image.save()
+    with UnitOfWork():
+        for model, images in by_model.items():
+
+            images = images[:]
+            prefer_raw = True
+            while len(images) > 0:
+                if model[1].name == "DSC-RX100":
+                    group, images = consume_group_exposure_bracketing(images)
+                elif model[1].name == "ZV-1" or model[1].name == "ILCE-6700":
+                    original_images = images
+                    group, images = consume_group_exposure_bracketing(original_images)
+                    group_burst, images_burst = consume_group_burst(original_images)
+                    if len(group_burst) > len(group):
+                        group, images = group_burst, images_burst
+                elif model[1].name == "Pixel 6":
+                    group, images = consume_group_pixel_6(images)
+                    prefer_raw = False
+
+                elif (
+                    model[1].name == "HERO9 Black" or
+                    model[1].name == "HERO11 Black"
+                ):
+                    group, images = consume_group_burst(images, timedelta(seconds=3))
+                    prefer_raw = False
+                elif (
+                    model[1].name == "HERO3+ Black Edition" or
+                    model[1].name == "iPhone 12 mini" or
+                    model[1].name == "iPhone 15 Pro Max"
+                ):
+                    group, images = images[:1], images[1:]
+                else:
+                    if model[1].name != '':
+                        for image in images:
+                            print(image)
+                        print("Unkown model {} - {}".format(*model))
+                    break
+
+                has_changes, will_degrade = validate_group(group, prefer_raw)
+                if has_changes:
+                    n += 1
+
+                    if not dry_run and (not will_degrade or force):
+                        for image in group:
+                            print("Saving {}".format(image))
+                            image.save()
 
     print("incorrect", n)
 
@@ -1,6 +1,6 @@
-from pytable.models import Image, ImageFlags, FilmRoll
+from pytable.models import Image, ImageFlags
+from pytable.database import open_library
 
-import peewee as pw
 import os
 import subprocess
 
@@ -12,8 +12,8 @@ real_folders = [
     "/home/oke/Pictures/DarktableRemote",
 ]
 
-query: list[Image] = Image.filter()
-pw.prefetch(query, FilmRoll)
+open_library(read_only=True)
+query: list[Image] = Image.select_profile("paths")
 images = list(query)
 import itertools
 
@@ -0,0 +1,23 @@
+from pytable.database import open_library
+from pytable.hashing import HashCache
+
+import sys
+
+
+def progress(done, total):
+    print("\rHashing: %d / %d" % (done, total), end="" if done < total else "\n", file=sys.stderr)
+
+
+def main():
+    open_library(read_only=True)
+    groups = HashCache().duplicates(progress=progress)
+    for group in groups:
+        print("%s (%.1f MB, %d copies)" % (group.digest, group.size / 1e6, len(group.images)))
+        for path, ids in sorted(group.images.items()):
+            print("    %s %s" % (path, ids))
+    print("%d duplicate groups, %.1f MB redundant" % (
+        len(groups), sum(group.size * (len(group.images) - 1) for group in groups) / 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,6 @@
 from pytable.models import Image, ImageFlags, FilmRoll
 
 from datetime import datetime
-import peewee as pw
 import os
 from pprint import pprint
 import subprocess
@@ -15,7 +14,6 @@ real_folders = [
 subprocess.check_call(["mountpoint", "/home/oke/Pictures/DarktableRemote"])
 
 query = Image.filter()
-pw.prefetch(query, FilmRoll)
 dry = True
 
 move_files = []
@@ -1,7 +1,6 @@
-from pytable.models import Image, ImageFlags, FilmRoll
+from pytable.models import Image, ImageFlags
 
 from datetime import datetime
-import peewee as pw
 import os
 import shutil
 
@@ -10,7 +9,6 @@ remove_secondary_before = datetime(2024, 6, 15)
 remove_rejected_before = datetime(2024, 6, 15)
 
 query = Image.filter()
-pw.prefetch(query, FilmRoll)
 
 def is_older_than(image, cmp):
    return (image.datetime_taken or image.datetime_imported) < cmp
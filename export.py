@@ -1,7 +1,6 @@
-from pytable.models import Color, Image, ImageFlags, FilmRoll, ColorLabel, TaggedImages
+from pytable.models import Color, Image, ImageFlags, ColorLabel, TaggedImages
 
 from datetime import datetime
-import peewee as pw
 import os
 import shutil
 import subprocess
@@ -16,7 +15,6 @@ query = (
     .where(ColorLabel.color == Color.BLUE)
     .where(Image.datetime_taken > datetime(2024, 6, 14, 22))
 )
-pw.prefetch(query, FilmRoll)
 
 def is_blog(image: Image):
     return (
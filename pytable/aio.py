@@ -0,0 +1,155 @@
+import asyncio
+import concurrent.futures
+import operator
+
+
+# Number of threads that execute queries for asyncio code. Peewee opens one
+# connection per thread, so each reader has its own connection.
+READER_THREADS = 4
+
+# Number of rows sent to the event loop at once when iterating
+CHUNK_SIZE = 1000
+
+# Query methods that build a new query and are therefore wrapped
+_BUILDER_METHODS = {
+    'select', 'where', 'orwhere', 'filter', 'join', 'switch', 'order_by',
+    'group_by', 'having', 'distinct', 'limit', 'offset', 'paginate',
+    'objects', 'dicts', 'tuples', 'namedtuples',
+}
+
+_reader_pool = None
+
+
+def reader_pool():
+    """
+    The thread pool in which all async queries are executed.
+    """
+    global _reader_pool
+    if _reader_pool is None:
+        _reader_pool = concurrent.futures.ThreadPoolExecutor(
+            READER_THREADS, thread_name_prefix='pytable-reader')
+    return _reader_pool
+
+
+class AsyncQuery:
+    """
+    asyncio facade for a peewee select. Query building methods (where,
+    join, order_by, ...) return a new AsyncQuery, executing methods are
+    coroutines that run the query in the reader pool:
+
+        images = AsyncQuery(Image.select())
+        rejected = await images.where(Image.flags.bin_and(8) != 0).fetch()
+        async for image in images:
+            ...
+    """
+
+    def __init__(self, query, executor=None, chunk_size=CHUNK_SIZE) -> None:
+        self.query = query
+        self.executor = executor
+        self.chunk_size = chunk_size
+
+    def __getattr__(self, name):
+        if name not in _BUILDER_METHODS:
+            raise AttributeError(name)
+        method = getattr(self.query, name)
+
+        def build(*args, **kwargs):
+            return AsyncQuery(
+                method(*args, **kwargs), self.executor, self.chunk_size)
+        return build
+
+    def _run(self, function, *args):
+        """
+        Call 'function' with a clone of the query and 'args' in the reader
+        pool. Peewee keeps the cursor of an executed query, each execution
+        therefore needs a query of its own.
+        """
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(
+            self.executor or reader_pool(),
+            lambda: function(self.query.clone(), *args))
+
+    async def fetch(self):
+        """
+        All rows of the query as list.
+        """
+        return await self._run(list)
+
+    async def get(self):
+        return await self._run(operator.methodcaller('get'))
+
+    async def first(self):
+        return await self._run(operator.methodcaller('first'))
+
+    async def count(self):
+        return await self._run(operator.methodcaller('count'))
+
+    async def exists(self):
+        return await self._run(operator.methodcaller('exists'))
+
+    async def to_columns(self, *fields):
+        return await self._run(operator.methodcaller('to_columns', *fields))
+
+    async def chunks(self):
+        """
+        Iterate over the rows in lists of up to 'chunk_size' rows. The rows
+        are read by one reader thread, which stays at most two chunks ahead
+        of the consumer.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=2)
+        stopped = False
+        done = object()
+
+        def produce(query):
+            try:
+                chunk = []
+                for row in query.iterator():
+                    chunk.append(row)
+                    if len(chunk) >= self.chunk_size:
+                        if stopped:
+                            return
+                        asyncio.run_coroutine_threadsafe(
+                            queue.put(chunk), loop).result()
+                        chunk = []
+                if chunk and not stopped:
+                    asyncio.run_coroutine_threadsafe(
+                        queue.put(chunk), loop).result()
+            except Exception as e:
+                asyncio.run_coroutine_threadsafe(queue.put(e), loop).result()
+                return
+            asyncio.run_coroutine_threadsafe(queue.put(done), loop).result()
+
+        producer = self._run(produce)
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is done:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            stopped = True
+            # Unblock the producer, it stops before sending the next chunk
+            while not producer.done():
+                while not queue.empty():
+                    queue.get_nowait()
+                await asyncio.sleep(0.001)
+            await producer
+
+    async def __aiter__(self):
+        chunks = self.chunks()
+        try:
+            async for chunk in chunks:
+                for row in chunk:
+                    yield row
+        finally:
+            await chunks.aclose()
+
+
+def aio(query, executor=None, chunk_size=CHUNK_SIZE):
+    """
+    Wrap the peewee 'query' for use from asyncio code, see AsyncQuery.
+    """
+    return AsyncQuery(query, executor, chunk_size)
@@ -0,0 +1,138 @@
+from .database import open_sidecar, MAX_VARIABLES
+from .models import Image
+
+from array import array
+from dataclasses import dataclass, field
+from typing import List, Optional
+import peewee as pw
+
+
+class Watermark(pw.Model):
+    """
+    The state of the library when a consumer last processed its changes.
+    Timestamps are raw darktable values.
+    """
+    consumer: str = pw.CharField(primary_key=True) # type: ignore
+    change_timestamp: int = pw.BigIntegerField() # type: ignore
+    write_timestamp: int = pw.BigIntegerField() # type: ignore
+    import_timestamp: int = pw.BigIntegerField() # type: ignore
+    # All image ids at that time as int64 array, used to detect deletions
+    ids: bytes = pw.BlobField() # type: ignore
+
+    class Meta:
+        db_table = 'watermarks'
+
+
+@dataclass
+class Changes:
+    """
+    Images inserted, modified and deleted since the last commit of a
+    consumer. 'watermark' is stored by 'ChangeFeed.commit'.
+    """
+    inserted: List[int] = field(default_factory=list)
+    modified: List[int] = field(default_factory=list)
+    deleted: List[int] = field(default_factory=list)
+    watermark: Optional[Watermark] = None
+
+    def __bool__(self):
+        return bool(self.inserted or self.modified or self.deleted)
+
+    def images(self, query=None):
+        """
+        Iterate over the inserted and modified images of 'query' (default:
+        all columns). Images are selected in chunks of MAX_VARIABLES ids, as
+        all images count as inserted on the first poll.
+        """
+        query = query if query is not None else Image.select()
+        for chunk in pw.chunked(sorted(self.inserted + self.modified), MAX_VARIABLES):
+            yield from query.where(Image.id.in_(chunk))
+
+
+def _raw(value):
+    # Compare timestamp columns without converting the value to datetime
+    return pw.Value(value, converter=False)
+
+
+class ChangeFeed:
+    """
+    Incremental view of the library for the consumer 'consumer':
+
+        feed = ChangeFeed("export")
+        changes = feed.poll()
+        for image in changes.images():
+            ...
+        feed.commit(changes)
+
+    The first poll of a consumer reports every image as inserted.
+    """
+
+    def __init__(self, consumer, database=None) -> None:
+        self.consumer = consumer
+        self.database = database or open_sidecar('changes.db')
+        with self.database.bind_ctx([Watermark]):
+            self.database.create_tables([Watermark], safe=True)
+
+    def _watermark(self):
+        with self.database.bind_ctx([Watermark]):
+            return Watermark.get_or_none(Watermark.consumer == self.consumer)
+
+    def poll(self) -> Changes:
+        """
+        Determine the changes since the last commit without storing them.
+        """
+        previous = self._watermark()
+
+        # Determine the new watermark first, changes made while we are
+        # querying are then reported by the next poll.
+        current = (Image
+            .select(pw.fn.MAX(Image.datetime_changed).coerce(False),
+                    pw.fn.MAX(Image.write_timestamp).coerce(False),
+                    pw.fn.MAX(Image.datetime_imported).coerce(False))
+            .tuples()
+            .get())
+        ids = array('q', sorted(id for id, in Image.select(Image.id).tuples()))
+        watermark = Watermark(
+            consumer=self.consumer,
+            change_timestamp=current[0] if current[0] is not None else -1,
+            write_timestamp=current[1] if current[1] is not None else -1,
+            import_timestamp=current[2] if current[2] is not None else -1,
+            ids=ids.tobytes())
+
+        if previous is None:
+            return Changes(inserted=list(ids), watermark=watermark)
+
+        previous_ids = array('q')
+        previous_ids.frombytes(previous.ids)
+        previous_ids = set(previous_ids)
+        current_ids = set(ids)
+
+        inserted = current_ids - previous_ids
+        modified = (Image
+            .select(Image.id)
+            .where(
+                (Image.datetime_changed > _raw(previous.change_timestamp)) |
+                (Image.write_timestamp > _raw(previous.write_timestamp)) |
+                (Image.datetime_imported > _raw(previous.import_timestamp)))
+            .tuples())
+        modified = set(id for id, in modified) - inserted
+
+        return Changes(
+            inserted=sorted(inserted),
+            modified=sorted(modified),
+            deleted=sorted(previous_ids - current_ids),
+            watermark=watermark)
+
+    def commit(self, changes: Changes):
+        """
+        Store the watermark of 'changes', so the next poll only reports
+        changes made afterwards.
+        """
+        with self.database.bind_ctx([Watermark]):
+            changes.watermark.save(force_insert=self._watermark() is None)
+
+    def reset(self):
+        """
+        Forget the watermark, the next poll reports all images as inserted.
+        """
+        with self.database.bind_ctx([Watermark]):
+            Watermark.delete().where(Watermark.consumer == self.consumer).execute()
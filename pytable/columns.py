@@ -0,0 +1,177 @@
+from .types import ImageFlags
+from .fields import DarktableTimestampField
+
+import functools
+import re
+import struct
+
+import numpy as np
+import peewee as pw
+
+
+# Columns that are computed from other columns after loading. Maps the name
+# of the derived column to (source column, dtype, function).
+DERIVED_COLUMNS = {
+    'stars': ('flags', np.int8, lambda flags: flags & 0x7),
+    'rejected': ('flags', np.bool_,
+                 lambda flags: (flags & ImageFlags.REJECTED.value) != 0),
+}
+
+# NULL values of integer columns are replaced with this value. Darktable uses
+# -1 as its own NULL for most integer columns.
+INTEGER_NULL = -1
+
+
+def field_dtype(field):
+    """
+    The numpy dtype used to store values of 'field'. Darktable timestamps
+    become 'datetime64[us]' and enums are kept as their integer code.
+    """
+    if isinstance(field, DarktableTimestampField):
+        return np.dtype('datetime64[us]')
+    if isinstance(field, pw.ForeignKeyField):
+        return field_dtype(field.rel_field)
+    if isinstance(field, pw.BooleanField):
+        return np.dtype(np.bool_)
+    if isinstance(field, pw.IntegerField):
+        return np.dtype(np.int64)
+    if isinstance(field, pw.FloatField):
+        return np.dtype(np.float64)
+    return np.dtype(object)
+
+
+def _resolve_field(model, field):
+    if isinstance(field, pw.Field):
+        return field.name, field
+    if field in model._meta.fields:
+        return field, model._meta.fields[field]
+    if field in model._meta.columns:
+        return field, model._meta.columns[field]
+    raise KeyError("%s has no field '%s'" % (model.__name__, field))
+
+
+def _select_expression(field, dtype):
+    if dtype.kind in 'iM':
+        return pw.fn.IFNULL(field, INTEGER_NULL)
+    return field
+
+
+def to_columns(query, fields=()):
+    """
+    Execute 'query' and return the result as a numpy structured array with
+    one column per field. Rows are read from the raw cursor, so no model
+    instances are created. Besides model fields, 'fields' may contain the
+    names of DERIVED_COLUMNS, e.g. 'stars' and 'rejected'. Their source
+    columns are part of the result as well.
+
+    If no fields are given, all fields except BLOBs are loaded.
+    """
+    model = query.model
+    if not fields:
+        fields = [f for f in model._meta.sorted_fields
+                  if not isinstance(f, pw.BlobField)]
+
+    loaded = {}
+    derived = []
+    for field in fields:
+        if isinstance(field, str) and field in DERIVED_COLUMNS:
+            derived.append(field)
+            field = DERIVED_COLUMNS[field][0]
+        name, field = _resolve_field(model, field)
+        loaded.setdefault(name, field)
+
+    names = list(loaded.keys())
+    dtypes = [field_dtype(f) for f in loaded.values()]
+    columns = query.select(*[
+        _select_expression(field, dtype)
+        for field, dtype in zip(loaded.values(), dtypes)])
+
+    rows = model._meta.database.execute(columns).fetchall()
+
+    dtype = np.dtype(
+        list(zip(names, dtypes)) +
+        [(name, DERIVED_COLUMNS[name][1]) for name in derived])
+
+    result = np.empty(len(rows), dtype=dtype)
+    for (name, field), values in zip(loaded.items(), zip(*rows)):
+        if isinstance(field, DarktableTimestampField):
+            values = field.python_values(values)
+        result[name] = values
+    for name in derived:
+        source, column_dtype, function = DERIVED_COLUMNS[name]
+        result[name] = function(result[source]).astype(column_dtype)
+    return result
+
+
+# numpy types of the struct format characters used in PARAMS_FORMAT
+_STRUCT_DTYPES = {
+    'b': np.int8, 'B': np.uint8, '?': np.bool_,
+    'h': np.int16, 'H': np.uint16,
+    'i': np.int32, 'I': np.uint32,
+    'q': np.int64, 'Q': np.uint64,
+    'f': np.float32, 'd': np.float64,
+}
+
+
+def _struct_items(params_format):
+    """
+    Split a struct format into (code, offset) for each value. A 's' item
+    is a single value of type 'S<count>'.
+    """
+    items = []
+    prefix = ""
+    for count, code in re.findall(r"(\d*)([a-zA-Z?])", params_format):
+        count = int(count) if count else 1
+        if code == 's':
+            token = "%ds" % count
+            offset = struct.calcsize(prefix + token) - count
+            items.append(("S%d" % count, offset))
+        else:
+            token = code
+            for _ in range(count):
+                offset = struct.calcsize(prefix + token) - struct.calcsize(token)
+                items.append((np.dtype(_STRUCT_DTYPES[code]), offset))
+                prefix += token
+            continue
+        prefix += token
+    return items
+
+
+@functools.lru_cache(maxsize=None)
+def params_dtype(module_cls):
+    """
+    The numpy structured dtype matching the binary layout of the
+    parameters of 'module_cls'. Array parameters ('name*n') become sub
+    arrays, shaped by 'PARAMS_SHAPES' if the module defines one. Enums are
+    kept as their integer code.
+    """
+    items = _struct_items(module_cls.PARAMS_FORMAT)
+    names, formats, offsets = [], [], []
+    for name in module_cls.PARAMS_NAMES:
+        n = 1
+        if "*" in name:
+            name, n = name.split("*")
+            n = int(n)
+        (format, offset), items = items[0], items[n:]
+        names.append(name)
+        offsets.append(offset)
+        shape = module_cls.PARAMS_SHAPES.get(name, (n,) if n > 1 else ())
+        formats.append((format, shape) if shape else format)
+    assert not items, items
+    return np.dtype({
+        'names': names, 'formats': formats, 'offsets': offsets,
+        'itemsize': module_cls.PARAMS_STRUCT.size})
+
+
+def decode_params(module_cls, blobs):
+    """
+    Decode many raw parameter blobs of 'module_cls' at once into a
+    structured array of 'params_dtype(module_cls)'.
+    """
+    dtype = params_dtype(module_cls)
+    blobs = [bytes(b) for b in blobs]
+    invalid = sum(1 for b in blobs if len(b) != dtype.itemsize)
+    if invalid:
+        raise ValueError("%d blobs do not match the size of %s params" % (
+            invalid, module_cls.__name__))
+    return np.frombuffer(b"".join(blobs), dtype=dtype)
@@ -1,17 +1,233 @@
 import peewee as pw
+import sqlite3
 import sys
 import os
+import urllib.parse
+
+
+LIBRARY_PATH = os.path.expanduser('~/.config/darktable/library.db')
+DATA_PATH = os.path.expanduser('~/.config/darktable/data.db')
+
+# Folder for the sidecar databases in which pytable stores data derived from
+# the library.
+CACHE_PATH = os.path.expanduser('~/.cache/pytable')
+
+# Pragmas applied to every connection. They only size the page cache and
+# temporary storage of our own connection and never change the database file.
+DEFAULT_PRAGMAS = (
+    ('cache_size', -64 * 1024),  # 64MiB
+    ('mmap_size', 1 << 30),
+    ('temp_store', 'memory'),
+)
+
+# Additional pragmas for connections opened with 'read_only=True'.
+READ_ONLY_PRAGMAS = (
+    ('query_only', 1),
+)
+
+# Maximum number of bound parameters in a single statement. This is the
+# lowest default of all sqlite versions.
+MAX_VARIABLES = 999
+
+# Name under which data.db is attached to the library connection, so that
+# tables from both databases can be joined in a single query.
+DATA_SCHEMA = 'data'
+
+db_library = pw.DatabaseProxy()
+db_data = pw.DatabaseProxy()
+
+
+def sqlite_uri(path, read_only=False, immutable=False):
+    """
+    Build a sqlite URI for 'path'. 'immutable' tells sqlite that the file
+    cannot change while it is open, which skips all locking. Only use it if
+    darktable is not running.
+    """
+    params = {}
+    if read_only or immutable:
+        params['mode'] = 'ro'
+    if immutable:
+        params['immutable'] = 1
+    uri = 'file:' + urllib.parse.quote(os.path.abspath(path))
+    if params:
+        uri += '?' + urllib.parse.urlencode(params)
+    return uri
+
+
+# Seconds between 0001-01-01 and the UNIX epoch. Darktable uses 0001-01-01 as
+# origin for most of its timestamps.
+_DT_EPOCH_OFFSET = 62135596800
+
+
+def dt_ts(value, origin):
+    """
+    SQL function: convert the darktable timestamp 'value' (microseconds
+    since 'origin', which is the year 1 or 1970) into UNIX seconds, for use
+    with sqlite's date functions and the 'unixepoch' modifier.
+    """
+    if value is None or value == -1:
+        return None
+    seconds = value / 10**6
+    if origin == 1:
+        seconds -= _DT_EPOCH_OFFSET
+    return seconds
+
+
+def dt_stars(flags):
+    """
+    SQL function: the star rating stored in image 'flags'.
+    """
+    return None if flags is None else flags & 0x7
+
+
+def dt_rejected(flags):
+    """
+    SQL function: 1 if the image 'flags' mark the image as rejected.
+    """
+    return None if flags is None else int(bool(flags & 0x8))
+
+
+# Functions registered on every connection to a darktable database
+SQL_FUNCTIONS = (
+    (dt_ts, 2),
+    (dt_stars, 1),
+    (dt_rejected, 1),
+)
+
+
+def _close(proxy):
+    if proxy.obj is not None and not proxy.is_closed():
+        proxy.close()
+
+
+def _connect_uri(uri, read_only, pragmas):
+    all_pragmas = list(DEFAULT_PRAGMAS)
+    if read_only:
+        all_pragmas += READ_ONLY_PRAGMAS
+    all_pragmas += list(pragmas)
+    database = pw.SqliteDatabase(uri, uri=True, pragmas=all_pragmas)
+    for function, num_params in SQL_FUNCTIONS:
+        database.register_function(
+            function, function.__name__, num_params, deterministic=True)
+    return database
+
+
+def connect(path, read_only=False, immutable=False, pragmas=()):
+    """
+    Create a (lazily connecting) database for the sqlite file at 'path'.
+    """
+    return _connect_uri(
+        sqlite_uri(path, read_only, immutable), read_only or immutable,
+        pragmas)
+
+
+def open_sidecar(name, pragmas=()):
+    """
+    Create a (lazily connecting) sidecar database 'name' in CACHE_PATH.
+    """
+    os.makedirs(CACHE_PATH, exist_ok=True)
+    return pw.SqliteDatabase(
+        os.path.join(CACHE_PATH, name),
+        pragmas=list(DEFAULT_PRAGMAS) + [('journal_mode', 'wal')] + list(pragmas))
+
+
+def execute_many(database, sql, rows):
+    """
+    Execute the statement 'sql' once for each parameter tuple in 'rows'.
+    """
+    return database.cursor().executemany(sql, rows)
+
+
+def open_library(library_path=LIBRARY_PATH, data_path=DATA_PATH,
+                 read_only=False, immutable=False, pragmas=()):
+    """
+    Bind all models to the darktable databases at 'library_path' and
+    'data_path'. Scripts that only scan the library should pass
+    'read_only=True'.
+
+    data.db is additionally attached to the library connection as
+    DATA_SCHEMA, which is where the models of data.db tables live.
+    """
+    return _bind(
+        sqlite_uri(library_path, read_only, immutable),
+        data_path and sqlite_uri(data_path, read_only, immutable),
+        read_only or immutable, pragmas)
+
+
+def _bind(library_uri, data_uri, read_only, pragmas):
+    _close(db_library)
+    if data_uri:
+        _close(db_data)
+
+    library = _connect_uri(library_uri, read_only, pragmas)
+    if data_uri:
+        library.attach(data_uri, DATA_SCHEMA)
+        db_data.initialize(_connect_uri(data_uri, read_only, pragmas))
+    db_library.initialize(library)
+    return db_library
+
+
+# Connections that keep in-memory snapshots alive
+_snapshot_connections = []
+
+
+def _backup(path, target, pages, sleep):
+    source = sqlite3.connect(sqlite_uri(path, read_only=True), uri=True)
+    try:
+        source.backup(target, pages=pages, sleep=sleep)
+    finally:
+        source.close()
+
+
+def open_library_snapshot(library_path=LIBRARY_PATH, data_path=DATA_PATH,
+                          folder=None, read_only=True, pages=256,
+                          sleep=0.001, pragmas=()):
+    """
+    Copy library.db and data.db with sqlite's online backup API and bind
+    all models to the copies. The copies are kept in memory, or in 'folder'
+    if given. The backup copies 'pages' pages per step and releases the
+    locks in between, so darktable is never blocked for long. Afterwards,
+    all reads are consistent and never wait for darktable.
+    """
+    while _snapshot_connections:
+        _snapshot_connections.pop().close()
+    if folder is not None:
+        os.makedirs(folder, exist_ok=True)
+
+    uris = []
+    for name, path in (('library', library_path), ('data', data_path)):
+        if not path:
+            uris.append(None)
+            continue
+        if folder is None:
+            # Shared cache, so that all connections see the same database
+            uri = 'file:pytable-%s-%d?mode=memory&cache=shared' % (
+                name, id(_snapshot_connections))
+        else:
+            uri = sqlite_uri(os.path.join(folder, name + '.db'))
+        target = sqlite3.connect(uri, uri=True)
+        _backup(path, target, pages, sleep)
+        if folder is None:
+            _snapshot_connections.append(target)
+        else:
+            target.close()
+        uris.append(uri)
+
+    return _bind(uris[0], uris[1], read_only, pragmas)
+
+
+def open_sqlite_db(sqlite_fn, data_fn=None, **kwargs):
+    """
+    Bind all models to the library 'sqlite_fn'. Tags live in data.db,
+    which is expected next to the library unless 'data_fn' is given.
+    Further arguments are passed to 'open_library'.
+    """
+    data_fn = data_fn or os.path.join(os.path.dirname(sqlite_fn), 'data.db')
+    if not os.path.exists(data_fn):
+        raise FileNotFoundError(
+            "data.db not found at '%s', pass its path as 'data_fn'" % data_fn)
+    return open_library(sqlite_fn, data_fn, **kwargs)
 
 
 if sys.platform == "linux":
-    db_library = pw.SqliteDatabase(
-        os.path.expanduser('~/.config/darktable/library.db'))
-    db_data = pw.SqliteDatabase(
-        os.path.expanduser('~/.config/darktable/data.db'))
-else:
-    db = pw.SqliteDatabase(None)
-    db_data = pw.SqliteDatabase(None)
-
-def open_sqlite_db(sqlite_fn):
-    global db
-    db = pw.init(sqlite_fn)
+    open_library()
@@ -0,0 +1,145 @@
+from .database import db_library, execute_many, MAX_VARIABLES
+from .models import Image, HistoryEntry, push_unit_of_work, pop_unit_of_work
+
+import datetime
+import peewee as pw
+
+
+def _update_sql(model, fields, keys):
+    """
+    UPDATE of the columns 'fields' of 'model' in the row identified by the
+    columns 'keys'. The placeholders are the values of 'fields', then those
+    of 'keys'.
+    """
+    meta = model._meta
+    return 'UPDATE "%s"."%s" SET %s WHERE %s' % (
+        meta.schema or 'main', meta.table_name,
+        ', '.join('"%s" = ?' % field.column_name for field in fields),
+        ' AND '.join('"%s" = ?' % key.column_name for key in keys))
+
+
+def touch_images(ids, when=None):
+    """
+    Set the change timestamp of the images 'ids' to 'when' (default: now),
+    so darktable and change based tools notice the modification.
+    """
+    when = when or datetime.datetime.now()
+    for chunk in pw.chunked(ids, MAX_VARIABLES):
+        (Image
+            .update({Image.datetime_changed: when})
+            .where(Image.id.in_(chunk))
+            .execute())
+
+
+def set_module_params(module, ids, update, instance=None):
+    """
+    Rewrite the parameters of 'module' (a Module subclass) in the active
+    history of the images 'ids'. 'update' is either a dict of parameter
+    values to set or a function that takes and returns a params dict. Only
+    the last active history entry of each module instance is rewritten
+    ('instance' restricts this to a single instance). Images that do not
+    use the module are left untouched.
+
+    All changes are written in one transaction. Returns the ids of the
+    modified images.
+    """
+    if isinstance(update, dict):
+        values = update
+
+        def update(params):
+            params.update(values)
+            return params
+
+    entries = {}
+    for chunk in pw.chunked(ids, MAX_VARIABLES):
+        query = (HistoryEntry
+            .select(HistoryEntry.image, HistoryEntry.num,
+                    HistoryEntry.instance, HistoryEntry.params)
+            .join(Image)
+            .where(HistoryEntry.image.in_(chunk) &
+                   (HistoryEntry.num < Image.history_end) &
+                   (HistoryEntry.module_name == module.NAME) &
+                   (HistoryEntry.version == module.VERSION))
+            .order_by(HistoryEntry.num.asc())
+            .tuples())
+        if instance is not None:
+            query = query.where(HistoryEntry.instance == instance)
+        for imgid, num, entry_instance, raw_params in query:
+            entries[(imgid, entry_instance)] = (num, raw_params)
+
+    rows = []
+    for (imgid, entry_instance), (num, raw_params) in entries.items():
+        params = update(dict(module(entry_instance, raw_params).params))
+        rows.append((module.encode_params(params, raw_params), imgid, num))
+
+    statement = _update_sql(
+        HistoryEntry, [HistoryEntry.params], [HistoryEntry.image, HistoryEntry.num])
+    modified = sorted(set(imgid for _, imgid, _ in rows))
+    with db_library.atomic():
+        for chunk in pw.chunked(rows, MAX_VARIABLES):
+            execute_many(db_library, statement, chunk)
+        touch_images(modified)
+    return modified
+
+
+class UnitOfWork:
+    """
+    Collect modified model instances and write them in a single transaction
+    when the context exits without an exception. Only dirty columns are
+    written, instances with the same set of dirty columns share one
+    executemany statement. 'Image.save' adds the image to the current unit
+    of work instead of writing it:
+
+        with UnitOfWork():
+            for image in images:
+                image.stars = 3
+                image.save()
+    """
+
+    def __init__(self, database=db_library) -> None:
+        self.database = database
+        self._instances = {}
+
+    def add(self, *instances):
+        for instance in instances:
+            self._instances[(type(instance), instance._pk)] = instance
+
+    def __enter__(self):
+        push_unit_of_work(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pop_unit_of_work(self)
+        if exc_type is None:
+            self.flush()
+        else:
+            self._instances.clear()
+
+    def flush(self):
+        """
+        Write all dirty columns of the collected instances.
+        """
+        batches = {}
+        for (model, pk), instance in self._instances.items():
+            dirty = set(instance.dirty_fields)
+            fields = tuple(
+                f.name for f in model._meta.sorted_fields
+                if f in dirty and f is not model._meta.primary_key)
+            if fields:
+                batches.setdefault((model, fields), []).append(instance)
+
+        with self.database.atomic():
+            for (model, fields), instances in batches.items():
+                meta = model._meta
+                statement = _update_sql(
+                    model, [meta.fields[f] for f in fields], [meta.primary_key])
+                rows = [
+                    tuple(meta.fields[f].db_value(instance.__data__.get(f))
+                          for f in fields) + (instance._pk,)
+                    for instance in instances]
+                for chunk in pw.chunked(rows, MAX_VARIABLES):
+                    execute_many(self.database, statement, chunk)
+
+        for instance in self._instances.values():
+            instance._dirty.clear()
+        self._instances.clear()
@@ -2,6 +2,7 @@ import peewee as pw
 
 import datetime
 import itertools
+import sqlite3
 
 class DarktableTimestampField(pw.TimestampField):
     """
@@ -20,6 +21,34 @@ class DarktableTimestampField(pw.TimestampField):
             return None
         return super().python_value(value - self.epoch_diff * self.resolution)
 
+    def python_values(self, values):
+        """
+        Convert a sequence of raw database values into a numpy
+        'datetime64[us]' array in a single vectorized operation. -1 and NULL
+        are mapped to NaT.
+
+        Unlike 'python_value', the result is never converted to local time.
+        Convert values to compare with using 'numpy_value'.
+        """
+        import numpy as np
+        values = np.asarray(
+            [-1 if v is None else v for v in values]
+            if not isinstance(values, np.ndarray) else values,
+            dtype=np.int64)
+        offset = int(self.epoch_diff) * self.resolution
+        result = (values - offset) * (10**6 // self.resolution)
+        result = result.astype('datetime64[us]')
+        result[values == -1] = np.datetime64('NaT')
+        return result
+
+    def numpy_value(self, value):
+        """
+        The 'datetime64[us]' that 'python_values' returns for the datetime
+        'value'. Fields that are not 'utc' interpret 'value' as local time,
+        like 'python_value' does.
+        """
+        return self.python_values([self.db_value(value)])[0]
+
     def db_value(self, value):
         if value is None or value == -1:
             return -1
@@ -31,7 +60,7 @@ class DarktableTimestampField(pw.TimestampField):
         else:
             raise ValueError()
 
-        return super().db_value(value) + self.epoch_diff * self.resolution
+        return super().db_value(value) + int(self.epoch_diff) * self.resolution
 
 class ModuleOrderListField(pw.CharField):
 
@@ -67,3 +96,40 @@ class EnumField(pw.IntegerField):
 
     def python_value(self, value):
         return self.enum_type(super().python_value(value))
+
+
+class LazyBlobAccessor(pw.FieldAccessor):
+
+    def __get__(self, instance, instance_type=None):
+        if (instance is not None and self.name not in instance.__data__ and
+                instance._pk is not None):
+            instance.__data__[self.name] = self.field.load(instance)
+        return super().__get__(instance, instance_type)
+
+
+class LazyBlobField(pw.BlobField):
+    """
+    A BLOB column that is not selected by default, but loaded on first
+    access. The model needs an integer primary key that is the rowid of the
+    table.
+    """
+    accessor_class = LazyBlobAccessor
+
+    def load(self, instance):
+        database = self.model._meta.database
+        connection = database.connection()
+        if hasattr(connection, 'blobopen'):
+            # Incremental blob I/O reads the value without running a query
+            try:
+                with connection.blobopen(
+                        self.model._meta.table_name, self.column_name,
+                        instance._pk, readonly=True,
+                        name=self.model._meta.schema or 'main') as blob:
+                    return blob.read()
+            except sqlite3.OperationalError:
+                # The value is NULL or not a BLOB
+                pass
+        return (self.model
+            .select(self)
+            .where(self.model._meta.primary_key == instance._pk)
+            .scalar())
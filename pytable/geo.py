@@ -0,0 +1,176 @@
+from .changes import ChangeFeed
+from .database import open_sidecar, MAX_VARIABLES
+from .models import Image
+
+from playhouse.sqlite_ext import VirtualModel
+import math
+import numpy as np
+import peewee as pw
+
+
+# Mean earth radius in km
+EARTH_RADIUS = 6371.0088
+
+
+class GeoBox(VirtualModel):
+    """
+    R*Tree entry of a geotagged image. The R*Tree stores 32 bit floats, so
+    boxes are only used to find candidates.
+    """
+    id: int = pw.IntegerField(primary_key=True) # type: ignore
+    min_lon: float = pw.FloatField() # type: ignore
+    max_lon: float = pw.FloatField() # type: ignore
+    min_lat: float = pw.FloatField() # type: ignore
+    max_lat: float = pw.FloatField() # type: ignore
+
+    class Meta:
+        db_table = 'image_geo_index'
+        extension_module = 'rtree'
+
+
+class GeoPoint(pw.Model):
+    """
+    Exact position of a geotagged image.
+    """
+    id: int = pw.IntegerField(primary_key=True) # type: ignore
+    longitude: float = pw.DoubleField() # type: ignore
+    latitude: float = pw.DoubleField() # type: ignore
+
+    class Meta:
+        db_table = 'image_geo'
+
+
+MODELS = [GeoBox, GeoPoint]
+
+
+def haversine(lon, lat, longitudes, latitudes):
+    """
+    Great circle distance in km between (lon, lat) and the arrays
+    'longitudes'/'latitudes'.
+    """
+    lon, lat = math.radians(lon), math.radians(lat)
+    longitudes, latitudes = np.radians(longitudes), np.radians(latitudes)
+    a = (np.sin((latitudes - lat) / 2) ** 2 +
+         math.cos(lat) * np.cos(latitudes) * np.sin((longitudes - lon) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def _boxes_around(lon, lat, radius):
+    """
+    Bounding boxes (min_lon, min_lat, max_lon, max_lat) containing every
+    point within 'radius' km of (lon, lat). Boxes crossing the antimeridian
+    are split.
+    """
+    dlat = math.degrees(radius / EARTH_RADIUS)
+    min_lat, max_lat = lat - dlat, lat + dlat
+    if min_lat <= -90 or max_lat >= 90:
+        return [(-180, max(min_lat, -90), 180, min(max_lat, 90))]
+    dlon = math.degrees(
+        math.asin(min(1.0, math.sin(radius / EARTH_RADIUS) / math.cos(math.radians(lat)))))
+    if dlon >= 180:
+        return [(-180, min_lat, 180, max_lat)]
+    min_lon, max_lon = lon - dlon, lon + dlon
+    if min_lon < -180:
+        return [(min_lon + 360, min_lat, 180, max_lat), (-180, min_lat, max_lon, max_lat)]
+    if max_lon > 180:
+        return [(min_lon, min_lat, 180, max_lat), (-180, min_lat, max_lon - 360, max_lat)]
+    return [(min_lon, min_lat, max_lon, max_lat)]
+
+
+class GeoIndex:
+    """
+    Spatial index over the positions of geotagged images, kept in the
+    sidecar database 'geo.db'. 'refresh' picks up images whose position
+    changed since the last refresh as well as images that were geotagged or
+    lost their position.
+    """
+
+    def __init__(self, database=None) -> None:
+        self.database = database or open_sidecar('geo.db')
+        with self.database.bind_ctx(MODELS):
+            self.database.create_tables(MODELS, safe=True)
+        self.feed = ChangeFeed('geo', self.database)
+
+    def refresh(self):
+        """
+        Bring the index up to date. Returns the number of updated images.
+        """
+        changes = self.feed.poll()
+        positions = Image.select(Image.id).where(
+            Image.longitude.is_null(False) & Image.latitude.is_null(False))
+        geotagged = set(id for id, in positions.tuples())
+
+        with self.database.bind_ctx(MODELS):
+            indexed = set(id for id, in GeoPoint.select(GeoPoint.id).tuples())
+            stale = (indexed - geotagged) | (set(changes.modified) & indexed)
+            new = (geotagged - indexed) | (set(changes.modified) & geotagged)
+
+            with self.database.atomic():
+                for chunk in pw.chunked(sorted(stale), MAX_VARIABLES):
+                    GeoBox.delete().where(GeoBox.id.in_(chunk)).execute()
+                    GeoPoint.delete().where(GeoPoint.id.in_(chunk)).execute()
+                for chunk in pw.chunked(sorted(new), MAX_VARIABLES):
+                    rows = list(Image
+                        .select(Image.id, Image.longitude, Image.latitude)
+                        .where(Image.id.in_(chunk))
+                        .tuples())
+                    GeoPoint.insert_many(rows, fields=[
+                        GeoPoint.id, GeoPoint.longitude, GeoPoint.latitude]).execute()
+                    GeoBox.insert_many([
+                        (id, lon, lon, lat, lat) for id, lon, lat in rows], fields=[
+                        GeoBox.id, GeoBox.min_lon, GeoBox.max_lon,
+                        GeoBox.min_lat, GeoBox.max_lat]).execute()
+        self.feed.commit(changes)
+        return len(stale | new)
+
+    def _points(self, boxes):
+        ids, longitudes, latitudes = [], [], []
+        with self.database.bind_ctx(MODELS):
+            for min_lon, min_lat, max_lon, max_lat in boxes:
+                query = (GeoPoint
+                    .select(GeoPoint.id, GeoPoint.longitude, GeoPoint.latitude)
+                    .join(GeoBox, on=(GeoBox.id == GeoPoint.id))
+                    .where((GeoBox.max_lon >= min_lon) & (GeoBox.min_lon <= max_lon) &
+                           (GeoBox.max_lat >= min_lat) & (GeoBox.min_lat <= max_lat))
+                    .where(GeoPoint.longitude.between(min_lon, max_lon) &
+                           GeoPoint.latitude.between(min_lat, max_lat))
+                    .tuples())
+                for id, lon, lat in query:
+                    ids.append(id)
+                    longitudes.append(lon)
+                    latitudes.append(lat)
+        return np.array(ids, dtype=np.int64), np.array(longitudes), np.array(latitudes)
+
+    def bbox(self, min_lon, min_lat, max_lon, max_lat):
+        """
+        Ids of all images inside the bounding box.
+        """
+        ids, _, _ = self._points([(min_lon, min_lat, max_lon, max_lat)])
+        return set(ids.tolist())
+
+    def _within(self, lon, lat, radius):
+        ids, longitudes, latitudes = self._points(_boxes_around(lon, lat, radius))
+        distances = haversine(lon, lat, longitudes, latitudes)
+        inside = distances <= radius
+        return ids[inside], distances[inside]
+
+    def radius(self, lon, lat, radius):
+        """
+        Ids of all images within 'radius' km of (lon, lat).
+        """
+        ids, _ = self._within(lon, lat, radius)
+        return set(ids.tolist())
+
+    def nearest(self, lon, lat, k=1):
+        """
+        The 'k' images closest to (lon, lat) as list of (id, distance in
+        km), closest first.
+        """
+        radius = 1.0
+        while True:
+            ids, distances = self._within(lon, lat, radius)
+            if len(ids) >= k or radius >= math.pi * EARTH_RADIUS:
+                break
+            radius *= 4
+        order = np.argsort(distances, kind='stable')[:k]
+        return [(int(ids[i]), float(distances[i])) for i in order]
@@ -0,0 +1,170 @@
+from .database import open_sidecar, MAX_VARIABLES
+from .models import Image
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List
+import hashlib
+import mmap
+import os
+import peewee as pw
+
+
+# Hash of the file contents, the same darktable would store in 'sha1sum'
+HASH_ALGORITHM = 'sha1'
+
+# Number of files handed to a worker process at once
+HASH_CHUNK_SIZE = 16
+
+
+class FileHash(pw.Model):
+    """
+    Cached content hash of a file. The hash is valid as long as size and
+    modification time of the file did not change.
+    """
+    path: str = pw.CharField(primary_key=True) # type: ignore
+    size: int = pw.BigIntegerField() # type: ignore
+    mtime_ns: int = pw.BigIntegerField() # type: ignore
+    digest: str = pw.CharField() # type: ignore
+
+    class Meta:
+        db_table = 'file_hashes'
+
+
+def hash_file(path):
+    """
+    Hex digest of the contents of 'path'. The file is mapped into memory and
+    hashed in one call, so the kernel reads it sequentially and hashlib
+    runs without the GIL.
+    """
+    digest = hashlib.new(HASH_ALGORITHM)
+    with open(path, 'rb') as f:
+        # Empty files can not be mapped
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if hasattr(data, 'madvise'):
+                    data.madvise(mmap.MADV_SEQUENTIAL)
+                digest.update(data)
+    return digest.hexdigest()
+
+
+def _hash_entry(entry):
+    path, size, mtime_ns = entry
+    try:
+        return path, size, mtime_ns, hash_file(path)
+    except OSError:
+        return path, size, mtime_ns, None
+
+
+@dataclass
+class DuplicateGroup:
+    """
+    Byte-identical files. 'images' maps each path to the ids of the images
+    (versions) that use it.
+    """
+    digest: str
+    size: int
+    images: Dict[str, List[int]] = field(default_factory=dict)
+
+    @property
+    def folders(self):
+        return sorted(set(os.path.dirname(path) for path in self.images))
+
+
+class HashCache:
+    """
+    Content hashes of files, kept in the sidecar database 'hashes.db'. Files
+    are only hashed if they are not in the cache or their size or
+    modification time changed. Hashing runs in a process pool.
+    """
+
+    def __init__(self, database=None, processes=None) -> None:
+        self.database = database or open_sidecar('hashes.db')
+        self.processes = processes
+        with self.database.bind_ctx([FileHash]):
+            self.database.create_tables([FileHash], safe=True)
+
+    def _cached(self, entries):
+        cached = {}
+        with self.database.bind_ctx([FileHash]):
+            for chunk in pw.chunked(list(entries), MAX_VARIABLES):
+                query = (FileHash
+                    .select(FileHash.path, FileHash.size, FileHash.mtime_ns, FileHash.digest)
+                    .where(FileHash.path.in_(chunk))
+                    .tuples())
+                for path, size, mtime_ns, digest in query:
+                    if entries[path] == (size, mtime_ns):
+                        cached[path] = digest
+        return cached
+
+    def hashes(self, paths, progress=None):
+        """
+        Map each of 'paths' to the digest of its contents. Paths that do not
+        exist or can not be read are left out. 'progress' is called with
+        (hashed, to hash) after each file that had to be hashed.
+        """
+        entries = {}
+        for path in set(paths):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries[path] = (stat.st_size, stat.st_mtime_ns)
+
+        digests = self._cached(entries)
+        todo = [(path, size, mtime_ns)
+                for path, (size, mtime_ns) in entries.items() if path not in digests]
+        # Hash big files first, so the pool does not end with a single one
+        todo.sort(key=lambda entry: entry[1], reverse=True)
+        if not todo:
+            return digests
+
+        with ProcessPoolExecutor(self.processes) as pool, \
+                self.database.bind_ctx([FileHash]):
+            results = pool.map(_hash_entry, todo, chunksize=HASH_CHUNK_SIZE)
+            batch = []
+            for done, (path, size, mtime_ns, digest) in enumerate(results, 1):
+                if digest is not None:
+                    digests[path] = digest
+                    batch.append((path, size, mtime_ns, digest))
+                if batch and (len(batch) >= 250 or done == len(todo)):
+                    # Write as the files are hashed, so an interrupted run
+                    # does not start from scratch
+                    with self.database.atomic():
+                        FileHash.replace_many(batch, fields=[
+                            FileHash.path, FileHash.size, FileHash.mtime_ns,
+                            FileHash.digest]).execute()
+                    batch = []
+                if progress:
+                    progress(done, len(todo))
+        return digests
+
+    def duplicates(self, query=None, progress=None):
+        """
+        Groups of byte-identical source files of the images of 'query'
+        (default: all images), e.g. the same raw imported into two film
+        rolls. Only files that share their size with another file are
+        hashed, as files of unique size can not have a duplicate.
+        """
+        query = query if query is not None else Image.select_profile("paths")
+        images = {}
+        for image in query:
+            path = os.path.join(image.film.folder, image.filename)
+            images.setdefault(path, []).append(image.id)
+
+        sizes, by_size = {}, {}
+        for path in images:
+            try:
+                sizes[path] = os.stat(path).st_size
+            except OSError:
+                continue
+            by_size.setdefault(sizes[path], []).append(path)
+        candidates = [path for paths in by_size.values() if len(paths) > 1 for path in paths]
+
+        groups = {}
+        for path, digest in self.hashes(candidates, progress).items():
+            group = groups.setdefault(digest, DuplicateGroup(digest, sizes[path]))
+            group.images[path] = sorted(images[path])
+        return sorted(
+            (group for group in groups.values() if len(group.images) > 1),
+            key=lambda group: -group.size)
@@ -0,0 +1,112 @@
+from .database import LIBRARY_PATH
+
+import datetime
+import hashlib
+import io
+import os
+
+
+# Cache folder of darktable
+DARKTABLE_CACHE_PATH = os.path.expanduser('~/.cache/darktable')
+
+# Maximum (width, height) of the mipmap levels darktable writes to disk
+MIPMAP_SIZES = (
+    (180, 110),
+    (360, 225),
+    (720, 450),
+    (1440, 900),
+    (1920, 1200),
+    (2560, 1600),
+    (4096, 2560),
+    (5120, 3200),
+)
+
+
+def mipmap_folder(library_path=LIBRARY_PATH, cache_path=DARKTABLE_CACHE_PATH):
+    """
+    The folder in which darktable stores the mipmaps of the library at
+    'library_path'. darktable names it after the SHA-1 of the library path
+    it was started with.
+    """
+    digest = hashlib.sha1(library_path.encode()).hexdigest()
+    return os.path.join(cache_path, 'mipmaps-%s.d' % digest)
+
+
+def mipmap_level(width, height=None):
+    """
+    The smallest mipmap level that is at least 'width' x 'height' pixels,
+    or the largest level if none is.
+    """
+    height = height if height is not None else width
+    for level, (w, h) in enumerate(MIPMAP_SIZES):
+        if w >= width and h >= height:
+            return level
+    return len(MIPMAP_SIZES) - 1
+
+
+class MipmapCache:
+    """
+    Read access to the thumbnails darktable keeps on disk, stored as
+    '<folder>/<level>/<image id>.jpg'.
+    """
+
+    def __init__(self, folder=None) -> None:
+        self.folder = folder or mipmap_folder()
+
+    def path(self, id, level):
+        return os.path.join(self.folder, str(level), '%d.jpg' % id)
+
+    def is_fresh(self, image, level):
+        """
+        Whether the mipmap 'level' of 'image' exists and shows the current
+        edit: it must not be older than the last change of the history and
+        the last thumbnail update, and not above 'thumb_maxmip' if darktable
+        recorded one.
+        """
+        if image.thumb_maxmip and level > image.thumb_maxmip:
+            return False
+        try:
+            mtime = os.stat(self.path(image.id, level)).st_mtime
+        except OSError:
+            return False
+        # darktable timestamps are local time
+        written = datetime.datetime.fromtimestamp(mtime)
+        return all(when is None or written >= when
+                   for when in (image.datetime_changed, image.datetime_thumb))
+
+    def read(self, image, level, fresh=True):
+        """
+        The JPEG data of the mipmap 'level' of 'image', or None if it does
+        not exist or (unless 'fresh' is False) is outdated.
+        """
+        if fresh and not self.is_fresh(image, level):
+            return None
+        try:
+            with open(self.path(image.id, level), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def preview(self, image, width, height=None, fallback=True):
+        """
+        A pillow image of 'image' that is (if possible) at least 'width' x
+        'height' pixels. Uses the smallest sufficient fresh mipmap, then the
+        largest smaller one. Without fresh mipmap the preview is loaded from
+        the source file (see 'pytable.similar.load_preview'), unless
+        'fallback' is False, in which case None is returned.
+        """
+        from PIL import Image as PILImage
+
+        wanted = mipmap_level(width, height)
+        levels = list(range(wanted, len(MIPMAP_SIZES))) + list(range(wanted - 1, -1, -1))
+        for level in levels:
+            data = self.read(image, level)
+            if data is not None:
+                return PILImage.open(io.BytesIO(data))
+
+        if not fallback:
+            return None
+        from .similar import load_preview
+        return load_preview(
+            os.path.join(image.film.folder, image.filename),
+            max(width, height or width), mode='RGB')
@@ -1,14 +1,79 @@
-from .database import db_library, db_data
-from .fields import DarktableTimestampField, ModuleOrderListField, EnumField
+from .database import db_library, DATA_SCHEMA, MAX_VARIABLES
+from .fields import DarktableTimestampField, ModuleOrderListField, EnumField, LazyBlobField
 from .types import ImageFlags, v30_jpg_order, v30_order, IOPOrderType, legacy_order, Color
-from .modules import DT_MODULES, Module
+from .modules import DT_MODULES, Module, get_module_class
 
 from typing import List
 import peewee as pw
 
+import collections
 import datetime
+import functools
+import threading
 
-class FilmRoll(pw.Model):
+class DimensionModel(pw.Model):
+    """
+    Base for small tables that are loaded completely on first access. Rows
+    are interned: every reference to the same row resolves to the same
+    instance.
+    """
+
+    @classmethod
+    def _identity_map_state(cls, reload=False):
+        # (database, rows by id, ids known to be missing)
+        database = cls._meta.database
+        database = getattr(database, 'obj', database)
+        cached = cls.__dict__.get('_identity_map')
+        if reload or cached is None or cached[0] is not database:
+            cached = (database, {row.id: row for row in cls.select()}, set())
+            cls._identity_map = cached
+        return cached
+
+    @classmethod
+    def identity_map(cls, reload=False):
+        """
+        All rows of the table keyed by id. The map is reloaded when models
+        are bound to a different database.
+        """
+        return cls._identity_map_state(reload)[1]
+
+    @classmethod
+    def cached(cls, id):
+        """
+        The row with 'id' from the identity map. Rows added since the map
+        was loaded are found by reloading it once. Ids that are still not
+        found (dangling references) are remembered and fail without another
+        reload, until the map is reloaded explicitly.
+        """
+        database, rows, missing = cls._identity_map_state()
+        if id not in rows and id not in missing:
+            rows = {row.id: row for row in cls.select()}
+            cls._identity_map = (database, rows, missing)
+            if id not in rows:
+                missing.add(id)
+        if id not in rows:
+            raise cls.DoesNotExist("%s with id %s does not exist" % (cls.__name__, id))
+        return rows[id]
+
+
+class CachedForeignKeyAccessor(pw.ForeignKeyAccessor):
+
+    def get_rel_instance(self, instance):
+        value = instance.__data__.get(self.name)
+        if value is not None and self.name not in instance.__rel__:
+            instance.__rel__[self.name] = self.rel_model.cached(value)
+        return super().get_rel_instance(instance)
+
+
+class CachedForeignKeyField(pw.ForeignKeyField):
+    """
+    A foreign key to a DimensionModel, resolved from its identity map
+    instead of querying the referenced row.
+    """
+    accessor_class = CachedForeignKeyAccessor
+
+
+class FilmRoll(DimensionModel):
     """
     A darktable filmroll.
     """
@@ -22,7 +87,7 @@ class FilmRoll(pw.Model):
         db_table = 'film_rolls'
         database = db_library
 
-class Maker(pw.Model):
+class Maker(DimensionModel):
 
     name: str = pw.CharField() # type: ignore
 
@@ -33,7 +98,7 @@ class Maker(pw.Model):
         db_table = 'makers'
         database = db_library
 
-class Model(pw.Model):
+class Model(DimensionModel):
 
     name: str = pw.CharField() # type: ignore
 
@@ -44,7 +109,7 @@ class Model(pw.Model):
         db_table = 'models'
         database = db_library
 
-class Lens(pw.Model):
+class Lens(DimensionModel):
 
     name: str = pw.CharField() # type: ignore
 
@@ -55,7 +120,7 @@ class Lens(pw.Model):
         db_table = 'lens'
         database = db_library
 
-class Camera(pw.Model):
+class Camera(DimensionModel):
 
     name: str = pw.CharField() # type: ignore
 
@@ -63,13 +128,140 @@ class Camera(pw.Model):
         db_table = 'cameras'
         database = db_library
 
+# Bits of Image::flags that hold the star rating
+STARS_MASK = 0x7
+
+# Stack of active units of work per thread, see 'pytable.edit.UnitOfWork'
+_units_of_work = threading.local()
+
+
+def current_unit_of_work():
+    stack = getattr(_units_of_work, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def push_unit_of_work(unit_of_work):
+    if not hasattr(_units_of_work, 'stack'):
+        _units_of_work.stack = []
+    _units_of_work.stack.append(unit_of_work)
+
+
+def pop_unit_of_work(unit_of_work):
+    _units_of_work.stack.remove(unit_of_work)
+
+
+# Maximum number of images whose active modules are cached
+ACTIVE_MODULES_CACHE_SIZE = 10000
+
+# Active modules of images of the bound database, keyed by (id, history_end,
+# datetime_changed), least recently used first. Callers get fresh Module
+# instances, see '_fresh_modules'.
+_active_modules_cache = (None, collections.OrderedDict())
+_active_modules_lock = threading.Lock()
+
+
+def _active_modules_of_database():
+    # Like the identity maps, the cache is dropped when the models are bound
+    # to a different database
+    global _active_modules_cache
+    database = db_library.obj
+    if _active_modules_cache[0] is not database:
+        _active_modules_cache = (database, collections.OrderedDict())
+    return _active_modules_cache[1]
+
+
+def _cached_active_modules(key):
+    with _active_modules_lock:
+        cache = _active_modules_of_database()
+        modules = cache.get(key)
+        if modules is not None:
+            cache.move_to_end(key)
+        return modules
+
+
+def _cache_active_modules(key, modules):
+    with _active_modules_lock:
+        cache = _active_modules_of_database()
+        cache[key] = modules
+        while len(cache) > ACTIVE_MODULES_CACHE_SIZE:
+            cache.popitem(last=False)
+    return modules
+
+
+def clear_active_modules_cache():
+    """
+    Forget the cached active modules of all images.
+    """
+    global _active_modules_cache
+    with _active_modules_lock:
+        _active_modules_cache = (None, collections.OrderedDict())
+
+
+def _fresh_modules(modules):
+    return [type(m)(m.instance, m.raw_params, m.module_name) for m in modules]
+
+
+@functools.lru_cache(maxsize=None)
+def _iop_positions(version, iop_list):
+    """
+    Map (module name, instance) to the position of the module in the pipe.
+    """
+    # 'iop_list' overrides the order for the case that
+    # 'version != CUSTOM'... Is this a bug in dt?
+    if iop_list is not None:
+        pass
+    elif version == IOPOrderType.V30:
+        iop_list = [(v, 0) for v in v30_order]
+    elif version == IOPOrderType.V30_JPG:
+        iop_list = [(v, 0) for v in v30_jpg_order]
+    elif version == IOPOrderType.LEGACY:
+        iop_list = [(v, 0) for v in legacy_order]
+    else:
+        raise NotImplementedError()
+
+    return {iop_list[i]: i for i in range(len(iop_list))}
+
+
+def _ordered_active_modules(active_history, module_order):
+    if len(active_history) == 0:
+        return []
+
+    if module_order is None:
+        raise ValueError("Image has history but no module order")
+
+    iop_list = None
+    if module_order.iop_list:
+        iop_list = tuple(module_order.iop_list)
+    iop_list = _iop_positions(module_order.version, iop_list)
+
+    active_modules = {}
+    for he in active_history:
+        if he.enabled:
+            active_modules[(he.module_name, he.instance)] = he.module
+        elif (he.module_name, he.instance) in active_modules:
+            del active_modules[(he.module_name, he.instance)]
+
+    active_modules = sorted(active_modules.items(), key=lambda kv: iop_list[kv[0]])
+    return list(map(lambda kv: kv[1], active_modules))
+
+
+class ImageSelect(pw.ModelSelect):
+
+    def to_columns(self, *fields):
+        """
+        Materialize the selected images as a numpy structured array. See
+        'pytable.columns.to_columns'.
+        """
+        from .columns import to_columns
+        return to_columns(self, fields)
+
 class Image(pw.Model):
     """
     A darktable image.
     """
     id: int = pw.IntegerField(primary_key=True) # type: ignore
     group = pw.ForeignKeyField('self')
-    film = pw.ForeignKeyField(FilmRoll)
+    film = CachedForeignKeyField(FilmRoll)
 
     # Image width in pixels
     width: int = pw.IntegerField() # type: ignore
@@ -80,13 +272,13 @@ class Image(pw.Model):
     filename: str = pw.CharField() # type: ignore
 
     # The maker of the camera used to capture this picture
-    maker = pw.ForeignKeyField(Maker)
+    maker = CachedForeignKeyField(Maker)
     # The model of the camera used to capture this picture
-    model = pw.ForeignKeyField(Model)
+    model = CachedForeignKeyField(Model)
     # The lens used to capture this picture
-    lens = pw.ForeignKeyField(Lens)
+    lens = CachedForeignKeyField(Lens)
     # The camera used to capture this picture
-    camera = pw.ForeignKeyField(Camera)
+    camera = CachedForeignKeyField(Camera)
 
     # The exposure used to capture this picture
     exposure = pw.FloatField()
@@ -128,7 +320,7 @@ class Image(pw.Model):
     latitude = pw.DoubleField()
     altitude = pw.DoubleField()
 
-    color_matrix = pw.BlobField()
+    color_matrix = LazyBlobField()
 
     colorspace: int = pw.IntegerField() # type: ignore
     version: int = pw.IntegerField() # type: ignore
@@ -147,77 +339,200 @@ class Image(pw.Model):
     datetime_thumb: datetime.datetime = DarktableTimestampField(origin=datetime.datetime(1, 1, 1), column_name="thumb_timestamp") # type: ignore
     thumb_maxmip: int = pw.IntegerField() # type: ignore
 
+    # Named sets of fields for scripts that only need part of an image, see
+    # 'select_profile'. 'full' also includes the lazily loaded BLOBs.
+    PROFILES = {
+        'paths': ('id', 'film', 'filename', 'version'),
+        'rating': ('id', 'group', 'flags', 'datetime_taken', 'datetime_imported'),
+        'exif': ('id', 'width', 'height', 'maker', 'model', 'lens', 'camera',
+                 'exposure', 'aperture', 'iso', 'focal_length',
+                 'focus_distance', 'exposure_bias', 'datetime_taken',
+                 'orientation', 'longitude', 'latitude', 'altitude'),
+        'full': None,
+    }
+
+    @classmethod
+    def select(cls, *fields):
+        is_default = not fields
+        if not fields:
+            fields = [f for f in cls._meta.sorted_fields
+                      if not isinstance(f, LazyBlobField)]
+        return ImageSelect(cls, fields, is_default=is_default)
+
+    @classmethod
+    def select_profile(cls, *profiles):
+        """
+        Select only the fields of the given PROFILES. Fields that are not
+        selected are None, except for lazy BLOBs which load on access.
+        """
+        names = set()
+        for profile in profiles:
+            if cls.PROFILES[profile] is None:
+                return cls.select(*cls._meta.sorted_fields)
+            names.update(cls.PROFILES[profile])
+        return cls.select(*[
+            f for f in cls._meta.sorted_fields if f.name in names])
+
+    def save(self, force_insert=False, only=None):
+        # Within a unit of work, changes are collected and written on exit
+        unit_of_work = current_unit_of_work()
+        if unit_of_work is not None and self.id is not None and not force_insert:
+            unit_of_work.add(self)
+            return 1
+        return super().save(force_insert, only)
+
     def flag(self, flag):
         return bool(self.flags & flag.value)
 
     def set_flag(self, flag, value):
-        b = -1
-        assert flag
-        flag = flag.value
-        while flag:
-            b += 1
-            flag = flag >> 1
-        self.flags = (self.flags & ~flag) | (value & flag)
-
-
+        """
+        Set (value is True) or clear (value is False) 'flag', leaving all
+        other flags untouched.
+        """
+        self.flags = (self.flags & ~flag.value) | (flag.value if value else 0)
+
+    @classmethod
+    def bulk_set(cls, ids, stars=None, rejected=None, flags_on=None, flags_off=None):
+        """
+        Change the rating and flags of the images 'ids' without loading them.
+        'stars' sets the star rating (0-5), 'rejected' sets or clears the
+        reject flag, 'flags_on' and 'flags_off' are ImageFlags (combined with
+        '|') to set and clear. Arguments that are None are left untouched.
+
+        Each chunk of ids is updated with a single
+        'flags = (flags & ~mask) | bits' statement, all in one transaction.
+        Returns the number of updated images.
+        """
+        mask, bits = 0, 0
+        if stars is not None:
+            if not 0 <= stars <= 5:
+                raise ValueError("stars must be between 0 and 5, not %r" % stars)
+            mask |= STARS_MASK
+            bits |= stars
+        if rejected is not None:
+            mask |= ImageFlags.REJECTED.value
+            bits |= ImageFlags.REJECTED.value if rejected else 0
+        if flags_off is not None:
+            mask |= flags_off.value
+        if flags_on is not None:
+            mask |= flags_on.value
+            bits |= flags_on.value
+        if not mask:
+            return 0
+
+        updated = 0
+        with cls._meta.database.atomic():
+            for chunk in pw.chunked(ids, MAX_VARIABLES):
+                updated += (cls
+                    .update({cls.flags: cls.flags.bin_and(~mask).bin_or(bits)})
+                    .where(cls.id.in_(chunk))
+                    .execute())
+        return updated
 
     @property
     def stars(self):
-        return self.flags & 0x7
+        return self.flags & STARS_MASK
 
     @stars.setter
     def stars(self, value):
-        self.flags = (self.flags & ~0x7) | (value & 0x7)
+        self.flags = (self.flags & ~STARS_MASK) | (value & STARS_MASK)
 
     def __str__(self):
         return self.filename
 
     history: pw.BackrefAccessor
     module_order: pw.BackrefAccessor
+    tags: pw.BackrefAccessor
+
+    @classmethod
+    def tagged(cls, *names):
+        """
+        Select all images that have at least one of the tags 'names'.
+        """
+        return (cls.select()
+            .join(TaggedImages)
+            .join(Tag)
+            .where(Tag.name.in_(names))
+            .distinct())
 
     def get_ordered_active_modules(self):
-
-        # nextline: type: ignore
-        active_history = (self.history
-            .order_by(HistoryEntry.num.asc()) # type: ignore
-            .where(HistoryEntry.num < self.history_end))
-
-        if len(active_history) == 0:
-            return []
-
-        module_orders = self.module_order.select()
-        module_order = module_orders[0]
-        iop_list = None
-        if module_order.version == IOPOrderType.CUSTOM:
-            iop_list = module_order.iop_list
-        elif module_order.version == IOPOrderType.V30:
-            iop_list = [(v, 0) for v in v30_order]
-        elif module_order.version == IOPOrderType.V30_JPG:
-            iop_list = [(v, 0) for v in v30_jpg_order]
-        elif module_order.version == IOPOrderType.LEGACY:
-            iop_list = [(v, 0) for v in legacy_order]
-        else:
-            raise NotImplementedError()
-
-        # Override if iop_list exists for the case that
-        # 'module_order.version != CUSTOM'... Is this a bug in dt?
-        if module_order.iop_list:
-            iop_list = module_order.iop_list
-
-        iop_list = {iop_list[i]: i for i in range(len(iop_list))}
-
-        active_modules = {}
-        for he in active_history:
-            if he.enabled:
-                active_modules[(he.module_name, he.instance)] = he.module
-            elif (he.module_name, he.instance) in active_modules:
-                del active_modules[(he.module_name, he.instance)]
-
-        active_modules = sorted(active_modules.items(), key=lambda kv: iop_list[kv[0]])
-        return list(map(lambda kv: kv[1], active_modules))
+        history_end = self.__data__.get('history_end')
+        datetime_changed = self.__data__.get('datetime_changed')
+        if 'history_end' not in self.__data__ or 'datetime_changed' not in self.__data__:
+            # Not selected, e.g. by a select profile
+            history_end, datetime_changed = (Image
+                .select(Image.history_end, Image.datetime_changed)
+                .where(Image.id == self.id)
+                .tuples()
+                .get())
+
+        key = (self.id, history_end, datetime_changed)
+        modules = _cached_active_modules(key)
+        if modules is None:
+
+            # nextline: type: ignore
+            active_history = (self.history
+                .order_by(HistoryEntry.num.asc()) # type: ignore
+                .where(HistoryEntry.num < history_end))
+
+            module_order = None
+            if len(active_history) != 0:
+                module_order = self.module_order.select()[0]
+
+            modules = _cache_active_modules(key, tuple(_ordered_active_modules(
+                active_history, module_order)))
+        return _fresh_modules(modules)
+
+    @classmethod
+    def get_ordered_active_modules_bulk(cls, ids):
+        """
+        Like 'get_ordered_active_modules', but for many images at once. The
+        history and module order of all images that are not cached yet is
+        fetched with one query each. Returns a dict mapping image ids to
+        their active modules.
+        """
+        keys = {}
+        for chunk in pw.chunked(ids, MAX_VARIABLES):
+            query = (cls
+                .select(cls.id, cls.history_end, cls.datetime_changed)
+                .where(cls.id.in_(chunk))
+                .tuples())
+            for key in query:
+                keys[key[0]] = key
+
+        modules = {}
+        for id, key in keys.items():
+            cached = _cached_active_modules(key)
+            if cached is not None:
+                modules[id] = cached
+        missing = [id for id in keys if id not in modules]
+
+        histories = {id: [] for id in missing}
+        module_orders = {}
+        for chunk in pw.chunked(missing, MAX_VARIABLES):
+            history = (HistoryEntry
+                .select()
+                .join(Image)
+                .where(HistoryEntry.image.in_(chunk) &
+                       (HistoryEntry.num < Image.history_end))
+                .order_by(HistoryEntry.image, HistoryEntry.num.asc()))
+            for he in history:
+                histories[he.imgid].append(he)
+
+            module_order = ModuleOrderEntry.select().where(
+                ModuleOrderEntry.image.in_(chunk))
+            for mo in module_order:
+                module_orders.setdefault(mo.imgid, mo)
+
+        for id in missing:
+            modules[id] = _cache_active_modules(keys[id], tuple(_ordered_active_modules(
+                histories[id], module_orders.get(id))))
+
+        return {id: _fresh_modules(modules[id]) for id in keys}
 
     class Meta:
         db_table = 'images'
+        only_save_dirty = True
         database = db_library # This model uses the "people.db" database``
 
 class ColorLabel(pw.Model):
@@ -252,11 +567,40 @@ class HistoryEntry(pw.Model):
 
     @property
     def module(self):
-        for cls in DT_MODULES:
-            if cls.NAME == self.module_name and cls.VERSION == self.version:
-                return cls(self.instance, self.params)
+        cls = get_module_class(self.module_name, self.version)
+        if cls:
+            return cls(self.instance, self.params)
         return Module(self.instance, self.params, module_name=self.module_name)
 
+    @classmethod
+    def params_columns(cls, module, query=None):
+        """
+        Decode the parameters of all history entries of 'module' (a Module
+        subclass) at once. Returns a numpy structured array with the fields
+        'imgid', 'num', 'instance' and 'params'. See
+        'pytable.columns.decode_params'.
+        """
+        import numpy as np
+        from .columns import decode_params, params_dtype
+
+        query = (query if query is not None else cls.select())
+        query = (query
+            .select(cls.image, cls.num, cls.instance, cls.params)
+            .where((cls.module_name == module.NAME) &
+                   (cls.version == module.VERSION)))
+        rows = cls._meta.database.execute(query).fetchall()
+
+        result = np.empty(len(rows), dtype=[
+            ('imgid', np.int64), ('num', np.int64), ('instance', np.int64),
+            ('params', params_dtype(module))])
+        if rows:
+            imgids, nums, instances, blobs = zip(*rows)
+            result['imgid'] = imgids
+            result['num'] = nums
+            result['instance'] = instances
+            result['params'] = decode_params(module, blobs)
+        return result
+
     def __str__(self):
         return "%3d - %sv%d-%s" % (
             self.num, self.module_name, self.version, self.instance)
@@ -291,7 +635,10 @@ class Tag(pw.Model):
 
     class Meta:
         db_table = 'tags'
-        database = db_data
+        # data.db is attached to the library connection, so tags can be
+        # joined with 'tagged_images'.
+        schema = DATA_SCHEMA
+        database = db_library
 
 class TaggedImages(pw.Model):
 
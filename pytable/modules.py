@@ -1,25 +1,56 @@
 from .types import Adaptation, ColorIntent, ColorSpacesColorProfile, \
     Illuminant, IlluminantLED, ImageOrientation
 
+import functools
 import struct
 import enum
 
 DT_MODULES = []
 
+# Module classes keyed by (NAME, VERSION)
+DT_MODULE_REGISTRY = {}
+
 
 def decode_bytes(bytes):
     return bytes.decode().rstrip("\0")
 
 
+def encode_value(value):
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, str):
+        return value.encode()
+    return value
+
+
 class ModuleMeta(type):
 
     def __new__(cls, name, bases, dct):
         new_cls = super().__new__(cls, name, bases, dct)
+        new_cls.PARAMS_STRUCT = (
+            struct.Struct(new_cls.PARAMS_FORMAT)
+            if new_cls.PARAMS_FORMAT else None)
         if name != "Module":
             DT_MODULES.append(new_cls)
+            DT_MODULE_REGISTRY[(new_cls.NAME, new_cls.VERSION)] = new_cls
         return new_cls
 
 
+@functools.lru_cache(maxsize=4096)
+def _decode_params(cls, raw_params):
+    # Identical blobs (e.g. default parameters) are only decoded once. The
+    # decoded values are immutable; callers get their own copy of the dict.
+    return cls.parse_params(raw_params)
+
+
+def get_module_class(name, version):
+    """
+    The Module subclass for darktable module 'name' in 'version' or None if
+    it is not supported.
+    """
+    return DT_MODULE_REGISTRY.get((name, version))
+
+
 class Module(metaclass=ModuleMeta):
 
     NAME = ""
@@ -27,19 +58,38 @@ class Module(metaclass=ModuleMeta):
     PARAMS_NAMES = ()
     PARAMS_FORMAT = ""
     PARAMS_TYPES = ()
+    # Shapes of array parameters for batch decoding, see
+    # 'pytable.columns.params_dtype'
+    PARAMS_SHAPES = {}
+
+    PARAMS_STRUCT = None
 
     def __init__(self, instance, raw_params, module_name=None) -> None:
         self.module_name = module_name or self.__class__.__name__
         self.instance = instance
-        self.params = self.parse_params(raw_params)
-
-    def parse_params(self, raw_params):
-        if not self.PARAMS_FORMAT:
+        self.raw_params = raw_params
+        self._params = None
+
+    @property
+    def params(self):
+        """
+        The decoded parameters. They are only decoded on first access.
+        """
+        if self._params is None:
+            raw_params = self.raw_params
+            if isinstance(raw_params, memoryview):
+                raw_params = bytes(raw_params)
+            self._params = dict(_decode_params(self.__class__, raw_params))
+        return self._params
+
+    @classmethod
+    def parse_params(cls, raw_params):
+        if not cls.PARAMS_STRUCT:
             return {}
-        values = struct.unpack(self.PARAMS_FORMAT, raw_params)
+        values = cls.PARAMS_STRUCT.unpack(raw_params)
         params = {}
-        pts = list(self.PARAMS_TYPES) + [None] * (len(self.PARAMS_NAMES) - len(self.PARAMS_TYPES))
-        for name, type in zip(self.PARAMS_NAMES, pts):
+        pts = list(cls.PARAMS_TYPES) + [None] * (len(cls.PARAMS_NAMES) - len(cls.PARAMS_TYPES))
+        for name, type in zip(cls.PARAMS_NAMES, pts):
             n = 1
             if "*" in name:
                 name, n = name.split("*")
@@ -47,13 +97,40 @@ class Module(metaclass=ModuleMeta):
             params[name] = values[:n]
             assert len(params[name]) == n
             if type:
-                params[name] = [type(v) for v in params[name]]
+                params[name] = tuple(type(v) for v in params[name])
             if n == 1:
                 params[name] = params[name][0]
             values = values[n:]
         assert not values, values
         return params
 
+    @classmethod
+    def encode_params(cls, params, raw_params=None):
+        """
+        Inverse of 'parse_params': serialize 'params' back into the binary
+        representation darktable stores in the history. Values that are not
+        part of 'params' (e.g. unused curve nodes) are taken from
+        'raw_params', the blob 'params' were decoded from, if given.
+        """
+        if not cls.PARAMS_STRUCT:
+            return b""
+        values = []
+        for name in cls.PARAMS_NAMES:
+            if "*" in name:
+                name, n = name.split("*")
+                assert len(params[name]) == int(n)
+                values.extend(encode_value(v) for v in params[name])
+            else:
+                values.append(encode_value(params[name]))
+        return cls.PARAMS_STRUCT.pack(*values)
+
+    def to_bytes(self):
+        """
+        The current (possibly modified) parameters of this module as bytes.
+        Unmodified parameters give back 'raw_params'.
+        """
+        return self.encode_params(self.params, self.raw_params)
+
     def __str__(self):
         import pprint
         return "%s-%d: %s" % (self.module_name, self.instance, pprint.pformat(
@@ -147,21 +224,38 @@ class ColorZonesV5(Module):
                     "curve_type*3", "strength", "mode", "spline_version")
 
     PARAMS_FORMAT = "i120f6ifii"
+    PARAMS_SHAPES = {"curve": (3, 20, 2)}
 
-    def parse_params(self, raw_params):
+    @classmethod
+    def parse_params(cls, raw_params):
         params = super().parse_params(raw_params)
         curve = params["curve"]
         curve = [
-            [(curve[channel * 20 * 2 + node * 2],
-              curve[channel * 20 * 2 + node * 2 + 1]) for node in range(20)]
+            tuple((curve[channel * 20 * 2 + node * 2],
+                   curve[channel * 20 * 2 + node * 2 + 1]) for node in range(20))
             for channel in range(3)
         ]
         curve[0] = curve[0][:params["curve_num_nodes"][0]]
         curve[1] = curve[1][:params["curve_num_nodes"][1]]
         curve[2] = curve[2][:params["curve_num_nodes"][2]]
-        params["curve"] = curve
+        params["curve"] = tuple(curve)
         return params
 
+    @classmethod
+    def encode_params(cls, params, raw_params=None):
+        params = dict(params)
+        # Nodes beyond 'curve_num_nodes' are kept as they are in the blob
+        unused = [0.0] * 120
+        if raw_params is not None:
+            unused = cls.PARAMS_STRUCT.unpack(raw_params)[1:121]
+        curve = []
+        for channel, nodes in enumerate(params["curve"]):
+            for node in nodes:
+                curve.extend(node)
+            curve.extend(unused[channel * 40 + len(nodes) * 2:(channel + 1) * 40])
+        params["curve"] = curve
+        return super().encode_params(params, raw_params)
+
 
 class DemosaicMethod(enum.Enum):
     PPG = 0
@@ -238,13 +332,22 @@ class DenoiseProfiled(Module):
 
     PARAMS_FORMAT = "8f6fi42f42fiiii"
     PARAMS_TYPES = [None] * 16 + [DenoiseProfiledWaveletMode]
+    PARAMS_SHAPES = {"x": (6, 7), "y": (6, 7)}
 
-    def parse_params(self, raw_params):
+    @classmethod
+    def parse_params(cls, raw_params):
         params = super().parse_params(raw_params)
-        params["x"] = [[params["x"][profile * 7 + band] for band in range(7)] for profile in range(6)]
-        params["y"] = [[params["y"][profile * 7 + band] for band in range(7)] for profile in range(6)]
+        params["x"] = tuple(tuple(params["x"][profile * 7 + band] for band in range(7)) for profile in range(6))
+        params["y"] = tuple(tuple(params["y"][profile * 7 + band] for band in range(7)) for profile in range(6))
         return params
 
+    @classmethod
+    def encode_params(cls, params, raw_params=None):
+        params = dict(params)
+        params["x"] = [v for profile in params["x"] for v in profile]
+        params["y"] = [v for profile in params["y"] for v in profile]
+        return super().encode_params(params, raw_params)
+
 
 class DiffuseOrSharpenV2(Module):
 
@@ -0,0 +1,114 @@
+from .database import db_library, MAX_VARIABLES
+from .models import Image
+
+import peewee as pw
+
+
+# Tables of library.db that reference images, as (table, image id column),
+# for schema versions that do not declare foreign keys. Tables that do not
+# exist in the library's schema version are skipped.
+DEPENDENT_TABLES = (
+    ('history', 'imgid'),
+    ('masks_history', 'imgid'),
+    ('history_hash', 'imgid'),
+    ('module_order', 'imgid'),
+    ('color_labels', 'imgid'),
+    ('tagged_images', 'imgid'),
+    ('selected_images', 'imgid'),
+    ('meta_data', 'id'),
+)
+
+
+class PurgeId(pw.Model):
+    """
+    Temporary table with the ids of the images purged in the current chunk.
+    """
+    id: int = pw.IntegerField(primary_key=True) # type: ignore
+
+    class Meta:
+        db_table = 'pytable_purge_ids'
+        database = db_library
+
+
+def dependent_tables():
+    """
+    All (table, column) of the library that reference images, taken from
+    the foreign keys declared by the schema and the existing tables of
+    DEPENDENT_TABLES, as not every schema version declares all of them.
+    """
+    existing = db_library.get_tables()
+    tables = [
+        (fk.table, fk.column)
+        for name in existing if name != Image._meta.table_name
+        for fk in db_library.get_foreign_keys(name)
+        if fk.dest_table == Image._meta.table_name]
+    tables += [(t, c) for t, c in DEPENDENT_TABLES if t in existing]
+    return list(dict.fromkeys(tables))
+
+
+def _purge_chunk(ids, tables):
+    PurgeId.delete().execute()
+    for chunk in pw.chunked(ids, MAX_VARIABLES):
+        PurgeId.insert_many([(id,) for id in chunk], fields=[PurgeId.id]).execute()
+    purged = PurgeId.select(PurgeId.id)
+
+    for name, column in tables:
+        table = pw.Table(name, (column,)).bind(db_library)
+        table.delete().where(getattr(table, column).in_(purged)).execute()
+
+    # Remaining members of groups whose leader is purged get a new leader.
+    # The new leaders are looked up before the update, which would otherwise
+    # see the groups it already rewrote and split them.
+    leaders = dict(Image
+        .select(Image.group, pw.fn.MIN(Image.id))
+        .where(Image.group.in_(purged) & Image.id.not_in(purged))
+        .group_by(Image.group)
+        .tuples())
+    # Three variables per group
+    for chunk in pw.chunked(sorted(leaders.items()), MAX_VARIABLES // 3):
+        (Image
+            .update({Image.group: pw.Case(Image.group, chunk)})
+            .where(Image.group.in_([old for old, _ in chunk]))
+            .execute())
+
+    Image.delete().where(Image.id.in_(purged)).execute()
+
+
+def vacuum():
+    """
+    Give the space of deleted rows back to the file system. Uses incremental
+    vacuum if the library is set up for it, otherwise a full VACUUM. Do not
+    run this while darktable is open.
+    """
+    auto_vacuum, = db_library.execute_sql('PRAGMA auto_vacuum').fetchone()
+    if auto_vacuum == 2:
+        db_library.execute_sql('PRAGMA incremental_vacuum').fetchall()
+    else:
+        db_library.execute_sql('VACUUM')
+
+
+def purge_images(ids, chunk_size=5000, progress=None, shrink=True):
+    """
+    Delete the images 'ids' together with all rows that reference them (see
+    'dependent_tables'). Each chunk of 'chunk_size' images is deleted in its
+    own transaction through a temporary id table, so any number of ids can
+    be purged. 'progress' is called with (purged, total) after each chunk.
+    Finally the file is shrunk with 'vacuum', unless 'shrink' is False.
+    """
+    ids = sorted(set(ids))
+    tables = dependent_tables()
+
+    PurgeId.create_table(temporary=True)
+    try:
+        done = 0
+        for chunk in pw.chunked(ids, chunk_size):
+            with db_library.atomic():
+                _purge_chunk(chunk, tables)
+            done += len(chunk)
+            if progress:
+                progress(done, len(ids))
+    finally:
+        PurgeId.drop_table()
+
+    if shrink and ids:
+        vacuum()
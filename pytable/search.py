@@ -0,0 +1,125 @@
+from .changes import ChangeFeed
+from .database import open_sidecar, MAX_VARIABLES
+from .models import Image, Tag, TaggedImages
+
+from playhouse.sqlite_ext import FTS5Model, SearchField, RowIDField
+import peewee as pw
+
+
+class ImageDocument(FTS5Model):
+    """
+    Full text index entry of an image. The rowid is the image id.
+    """
+    rowid = RowIDField()
+    filename = SearchField()
+    folder = SearchField()
+    tags = SearchField()
+
+    class Meta:
+        db_table = 'image_search'
+        # Prefix indexes make 'term*' queries fast
+        options = {'prefix': '2 3', 'tokenize': 'unicode61'}
+
+
+def _documents(ids):
+    tags = {}
+    query = (TaggedImages
+        .select(TaggedImages.image, Tag.name, Tag.synonyms)
+        .join(Tag)
+        .where(TaggedImages.image.in_(ids))
+        .tuples())
+    for imgid, name, synonyms in query:
+        tags.setdefault(imgid, []).extend(v for v in (name, synonyms) if v)
+
+    query = Image.select(Image.id, Image.filename, Image.film).where(Image.id.in_(ids))
+    for image in query:
+        yield {
+            ImageDocument.rowid: image.id,
+            ImageDocument.filename: image.filename,
+            ImageDocument.folder: image.film.folder,
+            ImageDocument.tags: " ".join(tags.get(image.id, [])),
+        }
+
+
+def match_expression(text, column=None):
+    """
+    FTS5 expression that matches documents containing all words in 'text'
+    as prefix of a token, optionally only in 'column'.
+    """
+    terms = ['"%s"*' % term.replace('"', '""') for term in text.split()]
+    expression = " ".join(terms)
+    if column:
+        expression = "%s : (%s)" % (column, expression)
+    return expression
+
+
+class SearchIndex:
+    """
+    Full text search over image filenames, film roll folders and tag names
+    and synonyms, kept in the sidecar database 'search.db'. 'refresh'
+    updates the index for images inserted, changed or deleted since the last
+    refresh. Tag edits in data.db that do not touch the image are only
+    picked up by 'rebuild'.
+    """
+
+    def __init__(self, database=None) -> None:
+        self.database = database or open_sidecar('search.db')
+        with self.database.bind_ctx([ImageDocument]):
+            self.database.create_tables([ImageDocument], safe=True)
+        self.feed = ChangeFeed('search', self.database)
+
+    def refresh(self):
+        """
+        Bring the index up to date. Returns the number of updated images.
+        """
+        changes = self.feed.poll()
+        stale = changes.modified + changes.deleted
+        new = changes.inserted + changes.modified
+        with self.database.bind_ctx([ImageDocument]), self.database.atomic():
+            for chunk in pw.chunked(stale, MAX_VARIABLES):
+                ImageDocument.delete().where(ImageDocument.rowid.in_(chunk)).execute()
+            # Four variables per document
+            for chunk in pw.chunked(new, MAX_VARIABLES // 4):
+                documents = list(_documents(chunk))
+                if documents:
+                    ImageDocument.insert_many(documents).execute()
+        self.feed.commit(changes)
+        return len(new) + len(changes.deleted)
+
+    def rebuild(self):
+        """
+        Drop and re-create the index from scratch.
+        """
+        with self.database.bind_ctx([ImageDocument]):
+            ImageDocument.delete().execute()
+        self.feed.reset()
+        return self.refresh()
+
+    def search(self, text, column=None):
+        """
+        Ids of all images matching every word of 'text' (as token prefix) in
+        their filename, folder or tags. 'column' restricts the search to one
+        of 'filename', 'folder' or 'tags'.
+        """
+        return self.match(match_expression(text, column))
+
+    def match(self, expression):
+        """
+        Ids of all images matching the FTS5 query 'expression'.
+        """
+        with self.database.bind_ctx([ImageDocument]):
+            query = (ImageDocument
+                .select(ImageDocument.rowid)
+                .where(ImageDocument.match(expression))
+                .tuples())
+            return set(id for id, in query)
+
+    def images(self, text, column=None, query=None):
+        """
+        Iterate over the images of 'query' (default: all columns) matching
+        'text', see 'search'. Images are selected in chunks of MAX_VARIABLES
+        ids, as broad terms may match the whole library.
+        """
+        query = query if query is not None else Image.select()
+        for chunk in pw.chunked(sorted(self.search(text, column)), MAX_VARIABLES):
+            yield from query.where(Image.id.in_(chunk))
@@ -0,0 +1,318 @@
+from .database import open_sidecar, MAX_VARIABLES
+from .models import Image
+
+from concurrent.futures import ProcessPoolExecutor
+import io
+import itertools
+import mmap
+import os
+import numpy as np
+import peewee as pw
+
+
+# Edge length of the grayscale previews the pHash is computed from
+PHASH_SIZE = 32
+
+# Edge length of the low frequency DCT block that makes up the pHash
+PHASH_BITS = 8
+
+# Number of 16 bit segments of a 64 bit hash in the multi-index
+SEGMENTS = 4
+
+# Number of previews handed to a worker process at once
+PREVIEW_CHUNK_SIZE = 8
+
+# Number of hashes computed and written at once
+HASH_BATCH_SIZE = 200
+
+
+class PerceptualHash(pw.Model):
+    """
+    Cached perceptual hashes of an image, valid as long as the modification
+    time of its source file did not change. Hashes are stored as signed 64
+    bit integers.
+    """
+    id: int = pw.IntegerField(primary_key=True) # type: ignore
+    mtime_ns: int = pw.BigIntegerField() # type: ignore
+    phash: int = pw.BigIntegerField() # type: ignore
+    dhash: int = pw.BigIntegerField() # type: ignore
+
+    class Meta:
+        db_table = 'perceptual_hashes'
+
+
+def _embedded_jpeg(path):
+    """
+    The largest JPEG embedded in the (raw) file 'path'.
+    """
+    from PIL import Image as PILImage
+
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        best, best_area = None, 0
+        start = data.find(b'\xff\xd8\xff')
+        while start != -1:
+            # The header is enough to know the size of the JPEG
+            try:
+                header = PILImage.open(io.BytesIO(data[start:start + (1 << 20)]))
+                if header.width * header.height > best_area:
+                    best, best_area = start, header.width * header.height
+            except OSError:
+                pass
+            start = data.find(b'\xff\xd8\xff', start + 3)
+        if best is None:
+            raise OSError("No preview found in %s" % path)
+        return PILImage.open(io.BytesIO(data[best:]))
+
+
+def load_preview(path, size=PHASH_SIZE, mode='L'):
+    """
+    Preview of the image file 'path' in the pillow 'mode', at least 'size'
+    pixels wide and high if possible. Files pillow can not read (e.g. raws)
+    are previewed with the largest JPEG embedded in them. JPEGs are decoded
+    at reduced resolution.
+    """
+    from PIL import Image as PILImage
+
+    try:
+        preview = PILImage.open(path)
+        preview.draft(mode, (size, size))
+        preview = preview.convert(mode)
+        if min(preview.size) >= size:
+            return preview
+    except OSError:
+        pass
+    preview = _embedded_jpeg(path)
+    preview.draft(mode, (size, size))
+    return preview.convert(mode)
+
+
+def _preview_pixels(path):
+    try:
+        preview = load_preview(path)
+    except Exception:
+        # Besides OSError pillow raises e.g. DecompressionBombError, one bad
+        # file must not abort the whole pool
+        return None
+    from PIL import Image as PILImage
+    small = np.asarray(preview.resize((PHASH_SIZE, PHASH_SIZE), PILImage.BOX), dtype=np.float32)
+    tiny = np.asarray(preview.resize((9, 8), PILImage.BOX), dtype=np.float32)
+    return small, tiny
+
+
+def _pack_bits(bits):
+    """
+    Pack the boolean array 'bits' of shape (n, 64) into n uint64 hashes.
+    """
+    return np.packbits(bits, axis=1).view('>u8').astype(np.uint64).ravel()
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    matrix = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n))
+    matrix[0] /= np.sqrt(2)
+    return matrix * np.sqrt(2 / n)
+
+
+def phash(pixels):
+    """
+    pHash of the grayscale images 'pixels' of shape (n, PHASH_SIZE,
+    PHASH_SIZE): the signs of the low frequencies of their 2D DCT relative
+    to the median. Returns n uint64.
+    """
+    dct = _dct_matrix(PHASH_SIZE)
+    coefficients = np.einsum('ij,njk,lk->nil', dct, pixels, dct)
+    low = coefficients[:, :PHASH_BITS, :PHASH_BITS].reshape(len(pixels), -1)
+    # The DC coefficient only reflects the brightness
+    median = np.median(low[:, 1:], axis=1, keepdims=True)
+    return _pack_bits(low > median)
+
+
+def dhash(pixels):
+    """
+    dHash of the grayscale images 'pixels' of shape (n, 8, 9): whether
+    each pixel is brighter than its right neighbour. Returns n uint64.
+    """
+    return _pack_bits((pixels[:, :, :-1] > pixels[:, :, 1:]).reshape(len(pixels), -1))
+
+
+def hamming(hash, hashes):
+    """
+    Number of differing bits between 'hash' and each of 'hashes'.
+    """
+    return np.bitwise_count(np.bitwise_xor(hashes, np.uint64(hash)))
+
+
+class HammingIndex:
+    """
+    Multi-index over 64 bit hashes for Hamming distance queries. Each hash
+    is split into SEGMENTS segments of 16 bits with a lookup table each. Two
+    hashes within distance 'radius' agree up to radius // SEGMENTS bits in
+    at least one segment, so only hashes sharing such a segment are
+    compared.
+    """
+
+    def __init__(self, ids, hashes) -> None:
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.tables = []
+        for segment in range(SEGMENTS):
+            keys = self._segment(self.hashes, segment)
+            order = np.argsort(keys, kind='stable')
+            values, starts = np.unique(keys[order], return_index=True)
+            ends = np.append(starts[1:], len(order))
+            self.tables.append({
+                int(v): order[s:e] for v, s, e in zip(values, starts, ends)})
+
+    @staticmethod
+    def _segment(hashes, segment):
+        return (hashes >> np.uint64(16 * segment)) & np.uint64(0xffff)
+
+    def _candidates(self, hash, radius):
+        flips = radius // SEGMENTS
+        masks = [0] + [
+            sum(1 << b for b in bits)
+            for n in range(1, flips + 1)
+            for bits in itertools.combinations(range(16), n)]
+        found = []
+        for segment, table in enumerate(self.tables):
+            key = int(self._segment(np.uint64(hash), segment))
+            found.extend(table[key ^ mask] for mask in masks if key ^ mask in table)
+        if not found:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(found))
+
+    def query(self, hash, radius):
+        """
+        All (id, distance) within Hamming distance 'radius' of 'hash',
+        closest first.
+        """
+        candidates = self._candidates(hash, radius)
+        distances = hamming(hash, self.hashes[candidates])
+        inside = distances <= radius
+        candidates, distances = candidates[inside], distances[inside]
+        order = np.argsort(distances, kind='stable')
+        return [(int(self.ids[c]), int(d)) for c, d in zip(candidates[order], distances[order])]
+
+    def similar(self, id, radius):
+        """
+        All other (id, distance) within 'radius' of the hash of image 'id'.
+        """
+        index, = np.nonzero(self.ids == id)
+        if not len(index):
+            raise KeyError(id)
+        return [(other, d) for other, d in self.query(self.hashes[index[0]], radius) if other != id]
+
+    def groups(self, radius):
+        """
+        Partition the ids into groups of images connected by distances of at
+        most 'radius'. Only groups of two or more images are returned.
+        """
+        parent = list(range(len(self.ids)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for i, hash in enumerate(self.hashes):
+            candidates = self._candidates(hash, radius)
+            candidates = candidates[candidates > i]
+            near = candidates[hamming(hash, self.hashes[candidates]) <= radius]
+            for j in near:
+                parent[find(int(j))] = find(i)
+
+        groups = {}
+        for i in range(len(self.ids)):
+            groups.setdefault(find(i), []).append(int(self.ids[i]))
+        return [group for group in groups.values() if len(group) > 1]
+
+
+class PerceptualHashCache:
+    """
+    pHash and dHash of the images' previews, kept in the sidecar database
+    'phash.db'. Hashes are only computed for images that are new or whose
+    source file changed. Previews are decoded in a process pool.
+    """
+
+    def __init__(self, database=None, processes=None) -> None:
+        self.database = database or open_sidecar('phash.db')
+        self.processes = processes
+        with self.database.bind_ctx([PerceptualHash]):
+            self.database.create_tables([PerceptualHash], safe=True)
+
+    def _write(self, pixels):
+        ids, mtimes, small, tiny = zip(*pixels)
+        phashes = phash(np.stack(small)).view(np.int64)
+        dhashes = dhash(np.stack(tiny)).view(np.int64)
+        rows = [(id, mtime_ns, int(p), int(d))
+                for id, mtime_ns, p, d in zip(ids, mtimes, phashes, dhashes)]
+        with self.database.atomic():
+            for chunk in pw.chunked(rows, MAX_VARIABLES // 4):
+                PerceptualHash.replace_many(chunk, fields=[
+                    PerceptualHash.id, PerceptualHash.mtime_ns,
+                    PerceptualHash.phash, PerceptualHash.dhash]).execute()
+        return rows
+
+    def _compute(self, todo, progress):
+        """
+        Hash the previews of 'todo' and yield the stored rows. Hashes are
+        computed and written in batches as the previews arrive, so an
+        interrupted run keeps its work.
+        """
+        with ProcessPoolExecutor(self.processes) as pool:
+            results = pool.map(
+                _preview_pixels, [path for _, path, _ in todo],
+                chunksize=PREVIEW_CHUNK_SIZE)
+            pixels = []
+            for done, ((id, _, mtime_ns), result) in enumerate(zip(todo, results), 1):
+                if result is not None:
+                    pixels.append((id, mtime_ns) + result)
+                if pixels and (len(pixels) >= HASH_BATCH_SIZE or done == len(todo)):
+                    yield from self._write(pixels)
+                    pixels = []
+                if progress:
+                    progress(done, len(todo))
+
+    def hashes(self, query=None, kind='phash', progress=None):
+        """
+        Arrays (ids, hashes) with the 'kind' ('phash' or 'dhash') of the
+        images of 'query' (default: all images). Images without readable
+        source file are left out. 'progress' is called with (done, to do)
+        for each image that had to be hashed.
+        """
+        query = query if query is not None else Image.select_profile("paths")
+        files = {}
+        for image in query:
+            path = os.path.join(image.film.folder, image.filename)
+            try:
+                files[image.id] = (path, os.stat(path).st_mtime_ns)
+            except OSError:
+                continue
+
+        cached = {}
+        with self.database.bind_ctx([PerceptualHash]):
+            for chunk in pw.chunked(list(files), MAX_VARIABLES):
+                query = (PerceptualHash
+                    .select(PerceptualHash.id, PerceptualHash.mtime_ns, getattr(PerceptualHash, kind))
+                    .where(PerceptualHash.id.in_(chunk))
+                    .tuples())
+                for id, mtime_ns, hash in query:
+                    if files[id][1] == mtime_ns:
+                        cached[id] = hash
+
+            todo = [(id, path, mtime_ns)
+                    for id, (path, mtime_ns) in files.items() if id not in cached]
+            column = 2 if kind == 'phash' else 3
+            cached.update((row[0], row[column]) for row in self._compute(todo, progress))
+
+        ids = np.array(sorted(cached), dtype=np.int64)
+        hashes = np.array([cached[id] for id in ids.tolist()], dtype=np.int64)
+        return ids, hashes.view(np.uint64)
+
+    def index(self, query=None, kind='phash', progress=None):
+        """
+        HammingIndex over the hashes of the images of 'query', see 'hashes'.
+        """
+        return HammingIndex(*self.hashes(query, kind, progress))
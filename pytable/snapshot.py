@@ -0,0 +1,214 @@
+from .columns import to_columns
+from .database import db_library, CACHE_PATH
+from .models import Image, FilmRoll, Maker, Model, Lens, Camera
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+# Tables stored in a snapshot besides the images
+DIMENSIONS = {
+    'film_rolls': (FilmRoll, ('id', 'folder')),
+    'makers': (Maker, ('id', 'name')),
+    'models': (Model, ('id', 'name')),
+    'lens': (Lens, ('id', 'name')),
+    'cameras': (Camera, ('id', 'name')),
+}
+
+
+def snapshot_folder(library_path, cache_path=CACHE_PATH):
+    """
+    The folder of the snapshot of the library at 'library_path'. Like the
+    mipmaps of darktable it is named after the SHA-1 of the library path, so
+    each library has its own snapshot.
+    """
+    digest = hashlib.sha1(library_path.encode()).hexdigest()
+    return os.path.join(cache_path, 'snapshot-%s' % digest)
+
+
+def snapshot_key(library_path):
+    """
+    Identify the state of the library file. The WAL file is part of the key,
+    as committed changes may only live in it.
+    """
+    key = {}
+    for suffix in ('', '-wal'):
+        try:
+            stat = os.stat(library_path + suffix)
+        except FileNotFoundError:
+            continue
+        key[suffix or 'db'] = [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+    return key
+
+
+class StringTable:
+    """
+    Strings stored as one utf-8 blob plus offsets, so they can be mapped
+    into memory without unpickling.
+    """
+
+    def __init__(self, data, offsets) -> None:
+        self.data = data
+        self.offsets = offsets
+
+    def __getitem__(self, index):
+        return bytes(self.data[self.offsets[index]:self.offsets[index + 1]]).decode()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lookup(self, indices):
+        return [self[i] for i in indices]
+
+
+class _StringTableBuilder:
+
+    def __init__(self) -> None:
+        self.indices = {}
+        self.encoded = []
+
+    def add(self, string):
+        if string not in self.indices:
+            self.indices[string] = len(self.encoded)
+            self.encoded.append((string or "").encode())
+        return self.indices[string]
+
+    def columns(self, values):
+        return np.array([self.add(v) for v in values], dtype=np.int32)
+
+    def build(self):
+        offsets = np.zeros(len(self.encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in self.encoded], out=offsets[1:])
+        data = np.frombuffer(b"".join(self.encoded), dtype=np.uint8)
+        return StringTable(data, offsets)
+
+
+def _replace_strings(columns, strings):
+    """
+    Replace all object columns of 'columns' by int32 indices into 'strings'.
+    """
+    dtype = [(name, np.int32 if columns.dtype[name] == object else columns.dtype[name])
+             for name in columns.dtype.names]
+    result = np.empty(len(columns), dtype=dtype)
+    for name in columns.dtype.names:
+        if columns.dtype[name] == object:
+            result[name] = strings.columns(columns[name])
+        else:
+            result[name] = columns[name]
+    return result
+
+
+class Snapshot:
+    """
+    Columnar copy of the images and small dimension tables of the library.
+    String columns (e.g. 'filename' or 'folder') hold indices into
+    'strings'.
+    """
+
+    def __init__(self, images, strings, **dimensions) -> None:
+        self.images = images
+        self.strings = strings
+        self.film_rolls = dimensions['film_rolls']
+        self.makers = dimensions['makers']
+        self.models = dimensions['models']
+        self.lens = dimensions['lens']
+        self.cameras = dimensions['cameras']
+
+    @classmethod
+    def build(cls):
+        """
+        Load a snapshot from the currently bound library.
+        """
+        strings = _StringTableBuilder()
+        images = _replace_strings(to_columns(Image.select()), strings)
+        dimensions = {
+            name: _replace_strings(to_columns(model.select(), fields), strings)
+            for name, (model, fields) in DIMENSIONS.items()}
+        return cls(images, strings.build(), **dimensions)
+
+    def save(self, path, key):
+        """
+        Write the snapshot to the folder 'path'. The folder is replaced
+        atomically.
+        """
+        parent = os.path.dirname(path)
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=parent)
+        arrays = {
+            'images': self.images,
+            'strings': self.strings.data,
+            'string_offsets': self.strings.offsets,
+            'film_rolls': self.film_rolls,
+            'makers': self.makers,
+            'models': self.models,
+            'lens': self.lens,
+            'cameras': self.cameras,
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), array)
+        with open(os.path.join(tmp, 'key.json'), 'w') as f:
+            json.dump(key, f)
+
+        # Left behind if a previous save was interrupted
+        old = path + '.old'
+        if os.path.exists(old):
+            shutil.rmtree(old)
+        if os.path.exists(path):
+            os.rename(path, old)
+            os.rename(tmp, path)
+            shutil.rmtree(old)
+        else:
+            os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path, key=None):
+        """
+        Map the snapshot in 'path' into memory. Returns None if it does not
+        exist or was taken for a different 'key'.
+        """
+        try:
+            with open(os.path.join(path, 'key.json')) as f:
+                if key is not None and json.load(f) != key:
+                    return None
+
+            def load(name):
+                return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+            strings = StringTable(load('strings'), load('string_offsets'))
+            return cls(load('images'), strings, **{
+                name: load(name) for name in DIMENSIONS})
+        except FileNotFoundError:
+            return None
+
+    def folders(self):
+        """
+        Map film roll ids to their folder.
+        """
+        return {int(id): self.strings[folder] for id, folder in self.film_rolls}
+
+
+def load_snapshot(cache_path=CACHE_PATH):
+    """
+    Return the snapshot of the bound library. It is mapped from its folder
+    in 'cache_path' (see 'snapshot_folder') if the library file did not
+    change since it was written, otherwise it is loaded from the library and
+    written there. Libraries without a file (e.g. in-memory copies) are
+    loaded every time.
+    """
+    library_path = {
+        name: file for _, name, file in db_library.execute_sql('PRAGMA database_list')
+    }.get('main')
+    if not library_path:
+        return Snapshot.build()
+    path = snapshot_folder(library_path, cache_path)
+    key = snapshot_key(library_path)
+    snapshot = Snapshot.load(path, key)
+    if snapshot is None:
+        snapshot = Snapshot.build()
+        snapshot.save(path, key)
+    return snapshot
@@ -0,0 +1,62 @@
+from .models import Image, FilmRoll, Maker, Model
+
+import peewee as pw
+
+
+def _date(format):
+    return pw.fn.strftime(
+        format, pw.fn.dt_ts(Image.datetime_taken, 1), 'unixepoch')
+
+
+def _star_class():
+    return pw.Case(
+        None, [(pw.fn.dt_rejected(Image.flags) == 1, -1)],
+        pw.fn.dt_stars(Image.flags))
+
+
+# Groupings of 'image_counts'. Each maps to a function that returns the SQL
+# expressions to group by and a function that turns the grouped values into
+# the reported key.
+GROUPINGS = {
+    'day': lambda: ([_date('%Y-%m-%d')], lambda d: d),
+    'week': lambda: ([_date('%Y-W%W')], lambda w: w),
+    'month': lambda: ([_date('%Y-%m')], lambda m: m),
+    'year': lambda: ([_date('%Y')], lambda y: y),
+    'stars': lambda: ([_star_class()], lambda s: s),
+    'camera': lambda: (
+        [Image.maker.coerce(False), Image.model.coerce(False)],
+        lambda maker, model: (
+            Maker.cached(maker).name if maker is not None else None,
+            Model.cached(model).name if model is not None else None)),
+    'film_roll': lambda: (
+        [Image.film.coerce(False)],
+        lambda film: FilmRoll.cached(film).folder if film is not None else None),
+}
+
+
+def image_counts(by, query=None, value=None):
+    """
+    Count the images of 'query' (default: all images) grouped by one of
+    GROUPINGS ('day', 'week', 'month', 'year', 'stars', 'camera' or
+    'film_roll'). Dates refer to the capture date, images without one are
+    reported under None. The aggregation runs inside sqlite using the
+    functions registered on the connection.
+
+    If 'value' (an expression on Image, e.g. Image.width * Image.height) is
+    given, its sum is reported as well. Returns a list of (key, count) or
+    (key, count, sum) tuples ordered by key.
+    """
+    expressions, make_key = GROUPINGS[by]()
+    columns = expressions + [pw.fn.COUNT(Image.id)]
+    if value is not None:
+        columns.append(pw.fn.SUM(value))
+
+    query = query if query is not None else Image.select()
+    query = (query
+        .select(*columns)
+        .group_by(*expressions)
+        .order_by(*expressions)
+        .tuples())
+
+    n = len(expressions)
+    return [(make_key(*row[:n]),) + tuple(row[n:]) for row in query]
@@ -0,0 +1,186 @@
+from .database import db_library, sqlite_uri, CACHE_PATH, DATA_SCHEMA
+from .models import Image, Tag, TaggedImages
+from .snapshot import snapshot_key
+
+import hashlib
+import json
+import os
+import peewee as pw
+
+
+# Separator of the levels of darktable's hierarchical tags
+SEPARATOR = '|'
+
+# Sidecar database with the closure table. It is attached to the library
+# connection as TAGS_SCHEMA, so it can be joined with 'tagged_images'.
+TAGS_PATH = os.path.join(CACHE_PATH, 'tags.db')
+TAGS_SCHEMA = 'pytable_tags'
+
+
+class TagClosure(pw.Model):
+    """
+    Closure table of the tag hierarchy: one row for each tag and each of its
+    ancestors (including the tag itself, with depth 0). Ancestors are stored
+    as path, as darktable does not require intermediate levels to exist as
+    tags ('places|europe|germany' may exist without 'places|europe').
+    """
+    ancestor: str = pw.CharField() # type: ignore
+    descendant: int = pw.IntegerField() # type: ignore
+    depth: int = pw.IntegerField() # type: ignore
+
+    class Meta:
+        db_table = 'tag_closure'
+        schema = TAGS_SCHEMA
+        database = db_library
+        primary_key = pw.CompositeKey('ancestor', 'descendant')
+        without_rowid = True
+
+
+class TagClosureKey(pw.Model):
+    """
+    State of data.db the closure table was built for, see '_data_key'.
+    """
+    key: str = pw.TextField() # type: ignore
+
+    class Meta:
+        db_table = 'tag_closure_key'
+        schema = TAGS_SCHEMA
+        database = db_library
+        primary_key = False
+
+
+MODELS = [TagClosure, TagClosureKey]
+
+
+def _attached():
+    return {name: file for _, name, file in db_library.execute_sql('PRAGMA database_list')}
+
+
+def _data_key():
+    # PRAGMA data_version can only be compared within one connection, so
+    # the closure table is keyed by the state of the data.db file like a
+    # snapshot (see 'snapshot_key'). In-memory copies are keyed by the tags.
+    path = _attached().get(DATA_SCHEMA)
+    if path:
+        return json.dumps([path, snapshot_key(path)])
+    digest = hashlib.sha1()
+    for id, name in Tag.select(Tag.id, Tag.name).order_by(Tag.id).tuples():
+        digest.update(b'%d\0%s\0' % (id, name.encode()))
+    return digest.hexdigest()
+
+
+def _closure_rows():
+    for id, name in Tag.select(Tag.id, Tag.name).tuples():
+        levels = name.split(SEPARATOR)
+        for i in range(1, len(levels) + 1):
+            yield SEPARATOR.join(levels[:i]), id, len(levels) - i
+
+
+def _build(path, key):
+    # Written through a connection of its own, the library connection only
+    # reads the sidecar and may stay read only.
+    rows = list(_closure_rows())
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    database = pw.SqliteDatabase(':memory:')
+    database.attach(path, TAGS_SCHEMA)
+    try:
+        database.execute_sql('PRAGMA %s.journal_mode = wal' % TAGS_SCHEMA)
+        with database.bind_ctx(MODELS):
+            database.create_tables(MODELS, safe=True)
+            with database.atomic():
+                TagClosure.delete().execute()
+                TagClosureKey.delete().execute()
+                # Three variables per row
+                for chunk in pw.chunked(rows, 300):
+                    TagClosure.insert_many(chunk, fields=[
+                        TagClosure.ancestor, TagClosure.descendant,
+                        TagClosure.depth]).execute()
+                TagClosureKey.insert(key=key).execute()
+    finally:
+        database.close()
+
+
+def tag_closure(path=TAGS_PATH):
+    """
+    The closure table of the tags. It is kept in the sidecar database
+    'path', shared by all processes and threads, and attached read only to
+    the library connection. It is rebuilt when data.db changed since it was
+    built.
+    """
+    key = _data_key()
+    if not os.path.exists(path):
+        _build(path, key)
+    if TAGS_SCHEMA not in _attached():
+        db_library.execute_sql('ATTACH DATABASE ? AS %s' % TAGS_SCHEMA, (
+            sqlite_uri(path, read_only=True),))
+    if TagClosureKey.select(TagClosureKey.key).scalar() != key:
+        _build(path, key)
+    return TagClosure
+
+
+def subtree(path, include_self=True):
+    """
+    Select the tags below 'path', including the tag 'path' itself unless
+    'include_self' is False.
+    """
+    closure = tag_closure()
+    query = (Tag
+        .select()
+        .join(closure, on=(closure.descendant == Tag.id))
+        .where(closure.ancestor == path))
+    if not include_self:
+        query = query.where(closure.depth > 0)
+    return query
+
+
+def _images_under(path):
+    closure = tag_closure()
+    return (TaggedImages
+        .select(TaggedImages.image)
+        .join(closure, on=(closure.descendant == TaggedImages.tag))
+        .where(closure.ancestor == path))
+
+
+def images_under(path, query=None):
+    """
+    Restrict 'query' (default: all images) to images with the tag 'path' or
+    any tag below it.
+    """
+    query = query if query is not None else Image.select()
+    return query.where(Image.id.in_(_images_under(path)))
+
+
+def untagged_under(path, query=None):
+    """
+    Restrict 'query' (default: all images) to images with neither the tag
+    'path' nor any tag below it.
+    """
+    query = query if query is not None else Image.select()
+    return query.where(Image.id.not_in(_images_under(path)))
+
+
+def tag_counts(root=None, max_depth=None):
+    """
+    Number of distinct images per node of the tag tree, as dict from path
+    to count. Images tagged with several tags below a node are counted
+    once. 'root' restricts the result to the subtree of 'root' (including
+    'root'), 'max_depth' to nodes at most 'max_depth' levels below the top
+    level (0) or 'root'.
+    """
+    closure = tag_closure()
+    query = (closure
+        .select(closure.ancestor, pw.fn.COUNT(TaggedImages.image.distinct()))
+        .join(TaggedImages, on=(TaggedImages.tag == closure.descendant))
+        .group_by(closure.ancestor))
+    if root is not None:
+        # All paths below 'root' sort between 'root|' and 'root}'
+        query = query.where(
+            (closure.ancestor == root) |
+            ((closure.ancestor > root + SEPARATOR) &
+             (closure.ancestor < root + chr(ord(SEPARATOR) + 1))))
+    counts = dict(query.tuples())
+    if max_depth is not None:
+        offset = root.count(SEPARATOR) if root is not None else 0
+        counts = {path: count for path, count in counts.items()
+                  if path.count(SEPARATOR) - offset <= max_depth}
+    return counts
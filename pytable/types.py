@@ -86,9 +86,10 @@ class Color(enum.Enum):
     BLUE = 3
     PURPLE = 4
 
-class ImageFlags(enum.Enum):
+class ImageFlags(enum.Flag):
     """
-    Flags that are stored in Image::flags. Extract flags with 'image.flag(flag)'
+    Flags that are stored in Image::flags. Extract flags with 'image.flag(flag)'.
+    Flags can be combined with '|' to form masks, e.g. for 'Image.bulk_set'.
 
     Extracted from:
     https:  """
@@ -97,7 +98,7 @@ class ImageFlags(enum.Enum):
     THUMBNAIL_DEPRECATED = 16
     # set during import if the image is low-dynamic range, i.e. doesn't
     # need demosaic, wb, highlight clipping etc.
-    LDR = 32,
+    LDR = 32
     # set during import if the image is raw data, i.e. it needs demosaicing.
     RAW = 64
     # set during import if images is a high-dynamic range image..
@@ -1,4 +1,5 @@
 from pytable.models import Image, ImageFlags, FilmRoll
+from pytable.purge import purge_images
 import os
 import sys
 
@@ -25,7 +26,7 @@ def should_remove(image):
     is_rejected = image.flag(ImageFlags.REJECTED)
     return is_rejected or (image.stars < 3 and not is_leader(image))
 
-query: list[Image] = Image.filter().prefetch(FilmRoll)
+query: list[Image] = Image.select_profile("paths", "rating")
 images = query
 images_to_remove = filter(should_remove, images)
 
@@ -51,5 +52,4 @@ for i in images_to_remove:
 
 if ids_to_remove and options.execute:
     print(len(ids_to_remove))
-    query = Image.delete().where(Image.id.in_(ids_to_remove))
-    query.execute()
+    purge_images(ids_to_remove, progress=lambda done, total: print("Purged %d / %d" % (done, total)))
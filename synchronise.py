@@ -1,6 +1,10 @@
 from pytable.models import Image, ImageFlags, FilmRoll
+from pytable.database import open_library
 
 from datetime import datetime
+import functools
+import numpy as np
+import operator
 import peewee as pw
 import os
 from dataclasses import dataclass
@@ -12,6 +16,9 @@ import shlex
 T = TypeVar('T')
 Range = Tuple[Optional[T], Optional[T]]
 
+# Image columns required by 'Filter.mask'
+COLUMNS = ('id', 'stars', 'rejected', 'datetime_taken', 'datetime_imported')
+
 
 class Filter:
 
@@ -21,6 +28,21 @@ class Filter:
     def matches(self, image: Image) -> bool:
         return True
 
+    def expression(self) -> Optional[pw.Node]:
+        """
+        The filter as peewee expression on Image, or None if the filter can
+        only be evaluated in python.
+        """
+        return None
+
+    def mask(self, columns: np.ndarray) -> Optional[np.ndarray]:
+        """
+        Vectorized 'matches' over image columns as returned by
+        'ImageSelect.to_columns', or None if the filter can only be
+        evaluated per image. See 'COLUMNS' for the required columns.
+        """
+        return None
+
     def __str__(self) -> str:
         return 'All'
 
@@ -46,6 +68,55 @@ class LocalRegion(Filter):
             return False
         return True
 
+    def expression(self) -> Optional[pw.Node]:
+        expression = pw.SQL('1')
+
+        rejected = Image.flags.bin_and(ImageFlags.REJECTED.value) != 0
+        stars = pw.Case(None, [(rejected, -1)], Image.flags.bin_and(0x7))
+        if self.stars_range[0] is not None:
+            expression &= stars >= self.stars_range[0]
+        if self.stars_range[1] is not None:
+            expression &= stars <= self.stars_range[1]
+
+        # Compare raw timestamps, the bounds are converted to darktable's
+        # representation once. datetime_taken is stored as UTC while
+        # datetime_imported is local time, so each column gets its own bound.
+        taken_missing = (
+            Image.datetime_taken.is_null() | (Image.datetime_taken == -1))
+        for bound, inside in zip(self.date_range, (operator.ge, operator.le)):
+            if bound is None:
+                continue
+            expression &= pw.Case(None, [(
+                taken_missing,
+                inside(Image.datetime_imported, pw.Value(
+                    Image.datetime_imported.db_value(bound), converter=False)))],
+                inside(Image.datetime_taken, pw.Value(
+                    Image.datetime_taken.db_value(bound), converter=False)))
+        return expression
+
+    def mask(self, columns: np.ndarray) -> np.ndarray:
+        result = np.ones(len(columns), dtype=np.bool_)
+
+        stars = np.where(columns['rejected'], -1, columns['stars'])
+        if self.stars_range[0] is not None:
+            result &= stars >= self.stars_range[0]
+        if self.stars_range[1] is not None:
+            result &= stars <= self.stars_range[1]
+
+        # The columns are not converted to local time, so the bounds are
+        # converted per column instead.
+        taken_missing = np.isnat(columns['datetime_taken'])
+        for bound, outside in zip(self.date_range, (np.less, np.greater)):
+            if bound is None:
+                continue
+            taken = Image.datetime_taken.numpy_value(bound)
+            imported = Image.datetime_imported.numpy_value(bound)
+            result &= ~np.where(
+                taken_missing,
+                outside(columns['datetime_imported'], imported),
+                outside(columns['datetime_taken'], taken))
+        return result
+
     def __str__(self) -> str:
         return f"LocalRange[({self.date_range[0] and self.date_range[0].strftime("%Y%m%d")}, {self.date_range[1] and self.date_range[1].strftime("%Y%m%d")}), ({self.stars_range[0]}, {self.stars_range[1]})]"
 
@@ -57,6 +128,19 @@ class Or(Filter):
     def matches(self, image: Image) -> bool:
         return any(f(image) for f in self.filters)
 
+    def expression(self) -> Optional[pw.Node]:
+        expressions = [f.expression() for f in self.filters]
+        if any(e is None for e in expressions):
+            return None
+        return functools.reduce(operator.or_, expressions, pw.SQL('0'))
+
+    def mask(self, columns: np.ndarray) -> Optional[np.ndarray]:
+        masks = [f.mask(columns) for f in self.filters]
+        if any(m is None for m in masks):
+            return None
+        return np.logical_or.reduce(
+            masks + [np.zeros(len(columns), dtype=np.bool_)])
+
     def __str__(self) -> str:
         return f"Or([\n\t{"\n\t".join((str(f) + ',' for f in self.filters))}\n])"
 
@@ -68,6 +152,19 @@ class And(Filter):
     def matches(self, image: Image) -> bool:
         return all(f(image) for f in self.filters)
 
+    def expression(self) -> Optional[pw.Node]:
+        expressions = [f.expression() for f in self.filters]
+        if any(e is None for e in expressions):
+            return None
+        return functools.reduce(operator.and_, expressions, pw.SQL('1'))
+
+    def mask(self, columns: np.ndarray) -> Optional[np.ndarray]:
+        masks = [f.mask(columns) for f in self.filters]
+        if any(m is None for m in masks):
+            return None
+        return np.logical_and.reduce(
+            masks + [np.ones(len(columns), dtype=np.bool_)])
+
     def __str__(self) -> str:
         return f"And([\n\t{"\n\t".join(('<' + str(f) + '>,' for f in self.filters))}\n])"
 
@@ -139,6 +236,25 @@ class SyncManager:
         self._config = config
         self._filter = filter
         self._files: Dict[str, SyncReq] = {}
+        self._required: Optional[set] = None
+
+    def evaluate_filter(self, query):
+        """
+        Evaluate the filter for all images of 'query' at once, preferably
+        inside sqlite. Afterwards, 'register_image' looks up the result
+        instead of calling the filter. Filters that support neither SQL nor
+        columns are still called per image.
+        """
+        expression = self._filter.expression()
+        if expression is not None:
+            required = query.select(Image.id).where(expression).tuples()
+            self._required = set(id for id, in required)
+            return
+
+        columns = query.to_columns(*COLUMNS)
+        mask = self._filter.mask(columns)
+        if mask is not None:
+            self._required = set(columns['id'][mask].tolist())
 
     def register_file(self, fn: str, requirement: SyncReq):
         if fn in self._files:
@@ -146,7 +262,10 @@ class SyncManager:
         self._files[fn] = requirement
 
     def register_image(self, image: Image):
-        required = self._filter(image)
+        if self._required is not None:
+            required = image.id in self._required
+        else:
+            required = self._filter(image)
         self.register_file(
             self._config.image_local_image(image),
             SyncReq.make(required, False)
@@ -255,8 +374,9 @@ def main():
 
     sync_manager = SyncManager(config, filter)
 
-    query = Image.filter()
-    pw.prefetch(query, FilmRoll)
+    open_library(read_only=True)
+    query = Image.select_profile("paths", "rating")
+    sync_manager.evaluate_filter(query)
     for image in query:
         sync_manager.register_image(image)
 
@@ -0,0 +1,67 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pytable.database import open_library
+
+
+# The tables of library.db and data.db the models use, as far as the tests
+# need them
+LIBRARY_SCHEMA = '''
+CREATE TABLE film_rolls (id INTEGER PRIMARY KEY, access_timestamp INTEGER, folder VARCHAR(1024) NOT NULL);
+CREATE TABLE makers (id INTEGER PRIMARY KEY, name VARCHAR);
+CREATE TABLE models (id INTEGER PRIMARY KEY, name VARCHAR);
+CREATE TABLE lens (id INTEGER PRIMARY KEY, name VARCHAR);
+CREATE TABLE cameras (id INTEGER PRIMARY KEY, name VARCHAR);
+CREATE TABLE images (id INTEGER PRIMARY KEY AUTOINCREMENT, group_id INTEGER, film_id INTEGER, width INTEGER, height INTEGER, filename VARCHAR,
+ maker_id INTEGER, model_id INTEGER, lens_id INTEGER, camera_id INTEGER, exposure REAL, aperture REAL, iso REAL, focal_length REAL, focus_distance REAL,
+ datetime_taken INTEGER, flags INTEGER, output_width INTEGER, output_height INTEGER, crop REAL, raw_parameters INTEGER, raw_black INTEGER, raw_maximum INTEGER,
+ orientation INTEGER, longitude REAL, latitude REAL, altitude REAL, color_matrix BLOB, colorspace INTEGER, version INTEGER, max_version INTEGER,
+ write_timestamp INTEGER, history_end INTEGER, position INTEGER, aspect_ratio REAL, exposure_bias REAL, import_timestamp INTEGER DEFAULT -1,
+ change_timestamp INTEGER DEFAULT -1, export_timestamp INTEGER DEFAULT -1, print_timestamp INTEGER DEFAULT -1, thumb_timestamp INTEGER DEFAULT -1,
+ thumb_maxmip INTEGER DEFAULT 0);
+CREATE TABLE color_labels (imgid INTEGER, color INTEGER);
+CREATE TABLE history (imgid INTEGER, num INTEGER, module INTEGER, operation VARCHAR(256), op_params BLOB, enabled INTEGER,
+ blendop_params BLOB, blendop_version INTEGER, multi_priority INTEGER, multi_name VARCHAR(256), multi_name_hand_edited INTEGER);
+CREATE TABLE module_order (imgid INTEGER PRIMARY KEY, version INTEGER, iop_list VARCHAR);
+CREATE TABLE tagged_images (imgid INTEGER, tagid INTEGER, position INTEGER, PRIMARY KEY (imgid, tagid));
+CREATE TABLE meta_data (id INTEGER, key INTEGER, value VARCHAR);
+INSERT INTO film_rolls VALUES (1, -1, '/tmp/pytable-test');
+'''
+
+DATA_SCHEMA = '''
+CREATE TABLE tags (id INTEGER PRIMARY KEY, name VARCHAR, synonyms VARCHAR, flags INTEGER);
+'''
+
+
+def add_images(path, groups):
+    """
+    Add an image for each (id, group id) of 'groups' to the library 'path'.
+    """
+    with sqlite3.connect(path) as connection:
+        connection.executemany(
+            "INSERT INTO images (id, group_id, film_id, filename, flags, history_end) "
+            "VALUES (?, ?, 1, 'IMG_' || ?, 0, 0)",
+            [(id, group, id) for id, group in groups])
+    connection.close()
+
+
+@pytest.fixture
+def library(tmp_path):
+    """
+    Path of an empty library, with all models bound to it.
+    """
+    paths = []
+    for name, schema in (('library.db', LIBRARY_SCHEMA), ('data.db', DATA_SCHEMA)):
+        path = str(tmp_path / name)
+        connection = sqlite3.connect(path)
+        connection.executescript(schema)
+        connection.close()
+        paths.append(path)
+    database = open_library(*paths)
+    yield paths[0]
+    database.close()
@@ -0,0 +1,34 @@
+import asyncio
+
+from conftest import add_images
+
+from pytable.aio import aio
+from pytable.models import Image
+
+
+def test_fetch_runs_query_again(library):
+    add_images(library, [(1, 1), (2, 2)])
+    images = aio(Image.select(Image.id).order_by(Image.id).tuples())
+
+    async def fetch_twice():
+        first = await images.fetch()
+        Image.delete().where(Image.id == 2).execute()
+        return first, await images.fetch()
+
+    first, second = asyncio.run(fetch_twice())
+    assert first == [(1,), (2,)]
+    assert second == [(1,)]
+
+
+def test_chunks_iterate_twice(library):
+    add_images(library, [(id, id) for id in range(1, 6)])
+    images = aio(Image.select(Image.id).order_by(Image.id).tuples(), chunk_size=2)
+
+    async def iterate_twice():
+        first = [chunk async for chunk in images.chunks()]
+        second = [row async for row in images]
+        return first, second
+
+    first, second = asyncio.run(iterate_twice())
+    assert first == [[(1,), (2,)], [(3,), (4,)], [(5,)]]
+    assert second == [(id,) for id in range(1, 6)]
@@ -0,0 +1,37 @@
+import sqlite3
+
+from conftest import add_images
+
+from pytable.edit import UnitOfWork, set_module_params
+from pytable.models import Image
+from pytable.modules import ExposureV6
+
+
+def test_set_module_params_rewrites_entry(library):
+    add_images(library, [(1, 1), (2, 2)])
+    blob = ExposureV6.PARAMS_STRUCT.pack(0, 0.0, 0.5, 50.0, -4.0, 1)
+    with sqlite3.connect(library) as connection:
+        connection.executemany(
+            "INSERT INTO history (imgid, num, module, operation, op_params, enabled) "
+            "VALUES (?, ?, 6, 'exposure', ?, 1)",
+            [(1, 0, blob), (1, 1, blob), (2, 0, blob)])
+        connection.execute("UPDATE images SET history_end = 2 WHERE id = 1")
+    connection.close()
+
+    assert set_module_params(ExposureV6, [1, 2], {"exposure": 1.5}) == [1]
+
+    rows = Image._meta.database.execute_sql(
+        "SELECT imgid, num, op_params FROM history ORDER BY imgid, num").fetchall()
+    assert [(imgid, num) for imgid, num, params in rows if params != blob] == [(1, 1)]
+    assert ExposureV6(0, rows[1][2]).params["exposure"] == 1.5
+
+
+def test_unit_of_work_writes_dirty_columns(library):
+    add_images(library, [(1, 1), (2, 2)])
+
+    with UnitOfWork():
+        for image in Image.select():
+            image.stars = image.id + 1
+            image.save()
+
+    assert dict(Image.select(Image.id, Image.flags).tuples()) == {1: 2, 2: 3}
@@ -0,0 +1,29 @@
+import sqlite3
+
+import pytest
+
+from pytable.models import FilmRoll
+
+
+def _add_film_roll(path, id):
+    with sqlite3.connect(path) as connection:
+        connection.execute("INSERT INTO film_rolls VALUES (?, -1, '/tmp')", (id,))
+    connection.close()
+
+
+def test_cached_reloads_for_new_rows(library):
+    assert FilmRoll.cached(1).id == 1
+    _add_film_roll(library, 2)
+    assert FilmRoll.cached(2).id == 2
+
+
+def test_cached_remembers_dangling_ids(library):
+    with pytest.raises(FilmRoll.DoesNotExist):
+        FilmRoll.cached(99)
+    _add_film_roll(library, 99)
+    # Not reloaded for a known dangling id
+    with pytest.raises(FilmRoll.DoesNotExist):
+        FilmRoll.cached(99)
+
+    FilmRoll.identity_map(reload=True)
+    assert FilmRoll.cached(99).id == 99
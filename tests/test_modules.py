@@ -0,0 +1,57 @@
+import enum
+import re
+import struct
+
+import pytest
+
+from pytable.modules import DT_MODULES, ColorZonesV5, decode_bytes
+
+
+def _format_codes(format):
+    codes = []
+    for count, code in re.findall(r'(\d*)([a-zA-Z?])', format):
+        count = int(count or 1)
+        codes.extend([code] if code == 's' else [code] * count)
+    return codes
+
+
+def _blob(module):
+    """
+    Parameters of 'module' with a different value in each field that are
+    valid for the field's type.
+    """
+    codes = _format_codes(module.PARAMS_FORMAT)
+    types = list(module.PARAMS_TYPES) + [None] * len(module.PARAMS_NAMES)
+    values = []
+    for name, type in zip(module.PARAMS_NAMES, types):
+        count = int(name.split("*")[1]) if "*" in name else 1
+        for _ in range(count):
+            code = codes[len(values)]
+            if isinstance(type, enum.EnumMeta):
+                values.append(next(iter(type)).value)
+            elif type is bool:
+                values.append(1)
+            elif type is decode_bytes or code == 's':
+                values.append(b"sRGB")
+            elif code == 'f':
+                values.append(len(values) + 0.25)
+            else:
+                values.append(len(values) % 7)
+    return module.PARAMS_STRUCT.pack(*values)
+
+
+@pytest.mark.parametrize("module", [m for m in DT_MODULES if m.PARAMS_STRUCT],
+                         ids=lambda module: module.__name__)
+def test_encode_decode_round_trip(module):
+    blob = _blob(module)
+    assert module(0, blob).to_bytes() == blob
+
+
+def test_colorzones_keeps_unused_nodes():
+    values = [0] + [i + 0.5 for i in range(120)] + [2, 3, 20, 0, 1, 2] + [1.0, 0, 3]
+    blob = ColorZonesV5.PARAMS_STRUCT.pack(*values)
+    colorzones = ColorZonesV5(0, blob)
+    assert len(colorzones.params["curve"][0]) == 2
+
+    assert colorzones.to_bytes() == blob
+    assert ColorZonesV5.encode_params(colorzones.params, blob) == blob
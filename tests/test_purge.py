@@ -0,0 +1,28 @@
+from conftest import add_images
+
+from pytable.models import Image
+from pytable.purge import dependent_tables, purge_images
+
+
+def test_purged_leader_keeps_group_together(library):
+    add_images(library, [(10, 10), (11, 10), (12, 10), (13, 10), (14, 10), (20, 20)])
+
+    purge_images([10], shrink=False)
+
+    groups = dict(Image.select(Image.id, Image.group).tuples())
+    assert groups == {11: 11, 12: 11, 13: 11, 14: 11, 20: 20}
+
+
+def test_purge_chunks_share_new_leaders(library):
+    add_images(library, [(id, 1) for id in range(1, 8)])
+
+    purge_images([1, 2, 3], chunk_size=1, shrink=False)
+
+    assert set(Image.select(Image.group).tuples()) == {(4,)}
+
+
+def test_dependent_tables_include_known_tables(library):
+    tables = dependent_tables()
+    assert ('history', 'imgid') in tables
+    assert ('meta_data', 'id') in tables
+    assert len(tables) == len(set(tables))